@@ -1,9 +1,13 @@
 from langchain.agents import AgentType, initialize_agent
 from langchain_anthropic.chat_models import ChatAnthropic
 from langchain.tools import BaseTool
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
+from langchain.agents.structured_chat.prompt import PREFIX as STRUCTURED_CHAT_PREFIX
+from langchain_core.callbacks import BaseCallbackHandler
+import asyncio
 import os
+import re
+import threading
+import time
 from typing import Optional, Type
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
@@ -13,11 +17,84 @@ from ai_prompt import ptbr as system_prompt
 load_dotenv()
 
 # Import MCP functions
-from main import get_databases, validate_query, plot_from_sql
+import main
+from main import get_databases, search_tables, validate_query, plot_from_sql
+from utils import run_blocking
+from cache import ResultCache
+import metrics
 
-# Initialize Claude
+ANSWER_CACHE_TTL = float(os.getenv("OPENQUERYBI_ANSWER_CACHE_TTL", "300"))
+answer_cache = ResultCache(max_entries=int(os.getenv("OPENQUERYBI_ANSWER_CACHE_ENTRIES", "256")))
+metrics.register_cache("answer", answer_cache)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+# Anthropic accepts at most this many cache_control breakpoints per request
+MAX_CACHE_BREAKPOINTS = 4
+
+class PromptCachingChatAnthropic(ChatAnthropic):
+    """ChatAnthropic that uses Anthropic prompt caching for the agent prompts.
+    The system message (instructions and tool descriptions) is cached as is. The human message is split after each
+    "Thought:" of the agent scratchpad, which ends every completed step, and the last completed step is marked, so that
+    each agent step reads the previous steps, including the schema returned by list_databases, from the cache.
+    """
+    def _get_request_payload(self, input_, *, stop=None, **kwargs):
+        payload = super()._get_request_payload(input_, stop=stop, **kwargs)
+        if isinstance(payload.get("system"), str):
+            payload["system"] = [{"type": "text", "text": payload["system"], "cache_control": CACHE_CONTROL}]
+        last = payload["messages"][-1] if payload["messages"] else None
+        if last is None:
+            return payload
+        if isinstance(last["content"], str):
+            last["content"] = [{"type": "text", "text": chunk} for chunk in re.split(r"(?<=\nThought:)", last["content"]) if chunk]
+        blocks = [block for block in last["content"] if isinstance(block, dict)] if isinstance(last["content"], list) else []
+        contents = [payload.get("system")] + [message["content"] for message in payload["messages"]]
+        breakpoints = sum(1 for content in contents if isinstance(content, list) for block in content if isinstance(block, dict) and "cache_control" in block)
+        if blocks and breakpoints < MAX_CACHE_BREAKPOINTS:
+            completed = [block for block in blocks if block.get("type") == "text" and block["text"].endswith("\nThought:")]
+            (completed or blocks)[-1]["cache_control"] = CACHE_CONTROL
+        return payload
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Record the duration and the token usage of the LLM calls of the agent.
+    """
+    def __init__(self):
+        self.starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self.starts.pop(run_id, None)
+        if start is not None:
+            metrics.observe("openquerybi_llm_duration_seconds", time.perf_counter() - start)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                details = usage.get("input_token_details") or {}
+                cached = (details.get("cache_read") or 0) + (details.get("cache_creation") or 0)
+                for kind, tokens in (("input", usage["input_tokens"] - cached), ("output", usage["output_tokens"]),
+                                     ("cache_read", details.get("cache_read")), ("cache_creation", details.get("cache_creation"))):
+                    if tokens:
+                        metrics.increment("openquerybi_llm_tokens_total", tokens, type=kind)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start = self.starts.pop(run_id, None)
+        if start is not None:
+            metrics.observe("openquerybi_llm_duration_seconds", time.perf_counter() - start)
+        metrics.increment("openquerybi_llm_errors_total")
+
+metrics_callback = MetricsCallbackHandler()
+
+# Claude and the agent are created on first use, see get_agent
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-llm = ChatAnthropic(model="claude-3-opus-20240229", anthropic_api_key=ANTHROPIC_API_KEY, temperature=0)
+llm = None
+agent = None
+_agent_lock = threading.Lock()
 
 # Tool input schemas
 class QueryInput(BaseModel):
@@ -34,6 +111,7 @@ class PlotInput(BaseModel):
     limit: Optional[int] = Field(100, description="Maximum number of rows")
     update_interval: Optional[int] = Field(10, description="Update interval in seconds")
     title: Optional[str] = Field("Graph requested to AI", description="Title of the graph")
+    incremental: Optional[bool] = Field(True, description="Refresh a line plot with a date/time x-axis by querying only its newest rows")
 
 # LangChain tools
 class DatabaseListTool(BaseTool):
@@ -43,27 +121,45 @@ class DatabaseListTool(BaseTool):
     def _run(self):
         return get_databases()
     
-    def _arun(self):
-        raise NotImplementedError("Async not supported")
+    async def _arun(self):
+        return await run_blocking(self._run)
+
+class SearchTablesInput(BaseModel):
+    question: str = Field(..., description="The question or keywords to search for")
+    top_k: Optional[int] = Field(5, description="Maximum number of tables to return")
+    database_name: Optional[str] = Field("", description="The name of the database to search in, empty for all")
+
+class SearchTablesTool(BaseTool):
+    name: str ="search_tables"
+    description: str = "Finds the tables relevant to a question and returns their schemas and sample data. Use it when list_databases only lists table names"
+    args_schema: Type[BaseModel] = SearchTablesInput
+    
+    def _run(self, question: str, top_k: int = 5, database_name: str = ""):
+        return search_tables(question=question, top_k=top_k, database_name=database_name)
+    
+    async def _arun(self, question: str, top_k: int = 5, database_name: str = ""):
+        return await run_blocking(self._run, question=question, top_k=top_k, database_name=database_name)
 
 class QueryDatabaseTool(BaseTool):
     name: str ="query_database"
+    handle_tool_error: bool = True
     description: str = "Execute a SQL query on a specified database (SELECT queries only)"
     args_schema: Type[BaseModel] = QueryInput
     
     def _run(self, database_name: str, query: str, limit: int = 100):
         return validate_query(database_name=database_name, query=query, limit=limit)
     
-    def _arun(self):
-        raise NotImplementedError("Async not supported")
+    async def _arun(self, database_name: str, query: str, limit: int = 100):
+        return await run_blocking(self._run, database_name=database_name, query=query, limit=limit)
 
 class CreatePlotTool(BaseTool):
     name: str ="create_plot"
+    handle_tool_error: bool = True
     description: str = "Create a line or bar plot from SQL query results"
     args_schema: Type[BaseModel] = PlotInput
     
     def _run(self, type: str, database_name: str, query: str, x: str, y: str,
-             limit: int = 100, update_interval: int = 10, title: str = "Graph requested to AI"):
+             limit: int = 100, update_interval: int = 10, title: str = "Graph requested to AI", incremental: bool = True):
         return plot_from_sql(
             type=type,
             database_name=database_name,
@@ -72,27 +168,62 @@ class CreatePlotTool(BaseTool):
             y=y,
             limit=limit,
             update_interval=update_interval,
-            title=title
+            title=title,
+            incremental=incremental
         )
     
-    def _arun(self):
-        raise NotImplementedError("Async not supported")
+    async def _arun(self, type: str, database_name: str, query: str, x: str, y: str,
+             limit: int = 100, update_interval: int = 10, title: str = "Graph requested to AI", incremental: bool = True):
+        return await run_blocking(
+            self._run,
+            type=type,
+            database_name=database_name,
+            query=query,
+            x=x,
+            y=y,
+            limit=limit,
+            update_interval=update_interval,
+            title=title,
+            incremental=incremental
+        )
 
 # Initialize tools
 tools = [
     DatabaseListTool(),
+    SearchTablesTool(),
     QueryDatabaseTool(),
     CreatePlotTool()
 ]
 
-# Create the agent
-agent = initialize_agent(
-    tools,
-    llm,
-    agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-    verbose=True,
-    return_intermediate_steps=True
-)
+def get_agent():
+    """Get the agent, creating the Claude client and the agent on the first call.
+    """
+    global llm, agent
+    if agent is None:
+        with _agent_lock:
+            if agent is None:
+                if llm is None:
+                    llm = PromptCachingChatAnthropic(model="claude-3-opus-20240229", anthropic_api_key=ANTHROPIC_API_KEY, temperature=0)
+                agent = initialize_agent(
+                    tools,
+                    llm,
+                    agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+                    verbose=True,
+                    return_intermediate_steps=True,
+                    agent_kwargs={"prefix": system_prompt + "\n\n" + STRUCTURED_CHAT_PREFIX}
+                )
+    return agent
+
+def get_answer_key(user_input: str):
+    """Get the answer cache key of a question: the question with its whitespace collapsed (literals such as 'Books'
+    and 'books' can differ only in case) and the version of the databases config, so that answers are not reused
+    after the configs change, even when they were changed by another process.
+    """
+    try:
+        version = os.stat(main.databases_config_path).st_mtime_ns
+    except OSError:
+        version = None
+    return (version, " ".join(user_input.split()))
 
 def process_query(user_input: str) -> str:
     """
@@ -104,10 +235,36 @@ def process_query(user_input: str) -> str:
     Returns:
         str: The response from the agent
     """
+    key = get_answer_key(user_input)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+    try:
+        response = get_agent().invoke(user_input, config={"callbacks": [metrics_callback]})
+        answer_cache.set(key, response, ANSWER_CACHE_TTL)
+        return dict(response)
+    except Exception as e:
+        return f"Error processing query: {str(e)}"
+
+async def aprocess_query(user_input: str) -> str:
+    """
+    Process a natural language query like process_query, without blocking the event loop
+    
+    Args:
+        user_input (str): The user's natural language query
+        
+    Returns:
+        str: The response from the agent
+    """
+    key = get_answer_key(user_input)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        return dict(cached)
     try:
-        prompt = 'System prompt: \n'+system_prompt + f"\nUser Query: \n{user_input}"
-        response = agent.invoke(prompt)
-        return response
+        agent = await asyncio.to_thread(get_agent)
+        response = await agent.ainvoke(user_input, config={"callbacks": [metrics_callback]})
+        answer_cache.set(key, response, ANSWER_CACHE_TTL)
+        return dict(response)
     except Exception as e:
         return f"Error processing query: {str(e)}"
 
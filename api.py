@@ -1,12 +1,40 @@
 import utils
-from main import databases_config_path
-from fastapi import FastAPI,Body, Request
+import catalog
+import incremental
+import rollups
+import metrics
+import shared_cache
+from fastapi import FastAPI,Body, Request, HTTPException
 from pydantic import BaseModel
 import json
-from ai import process_query
+import os
+import sys
+import time
+import asyncio
+import importlib
+from cache import ResultCache, json_default, encode_json
+from typing import Optional
+from scheduler import PlotScheduler
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 
-app = FastAPI()
+# "full" serves the plots and the /ai agent, "plots" only the plots and databases, without importing the AI stack
+API_MODE = os.getenv("OPENQUERYBI_API_MODE", "full")
+databases_config_path = utils.databases_config_path
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    if os.getenv("OPENQUERYBI_SCHEDULER", "1") == "1":
+        plot_scheduler.start()
+    if rollup_store is not None:
+        rollup_store.start()
+    yield
+    await plot_scheduler.stop()
+    if rollup_store is not None:
+        await rollup_store.stop()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # or your frontend URL
@@ -15,29 +43,237 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request:Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.observe(
+            "openquerybi_http_request_duration_seconds", time.perf_counter() - start,
+            route=route.path if route is not None else "unmatched", method=request.method, status=status
+        )
+
+# Cache shared by the workers of a multi-process deployment, e.g. sqlite:///shared_cache.db or redis://localhost:6379/0
+shared_backend = shared_cache.get_backend(os.getenv("OPENQUERYBI_SHARED_CACHE", ""))
+worker_id = shared_cache.get_owner()
+plot_cache_options = dict(
+    max_entries=int(os.getenv("OPENQUERYBI_PLOT_CACHE_ENTRIES", "1024")),
+    max_bytes=int(os.getenv("OPENQUERYBI_PLOT_CACHE_BYTES", str(64*1024*1024)))
+)
+if shared_backend is None:
+    plot_cache = ResultCache(**plot_cache_options)
+else:
+    plot_cache = shared_cache.SharedResultCache(shared_backend, owner=worker_id, **plot_cache_options)
+metrics.register_cache("plot", plot_cache)
+
+# The plot data cache, the scheduler jobs and the dicts below are keyed by plot fingerprint,
+# so that equivalent plots share their data (see utils.get_plot_fingerprint)
+
+# Number of incremental refreshes of each plot since its last full refresh
+incremental_refreshes = {}
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+plot_scheduler = PlotScheduler(
+    plot_cache,
+    lambda key, plot_info: load_plot_data(key, plot_info),
+    idle_timeout=float(os.getenv("OPENQUERYBI_SCHEDULER_IDLE_TIMEOUT", "300")),
+    max_concurrency_per_database=int(os.getenv("OPENQUERYBI_SCHEDULER_CONCURRENCY", "2")),
+    leases=shared_backend,
+    owner=worker_id
+)
+
+# Materialized results of hot aggregate plots, only when OPENQUERYBI_ROLLUPS=1
+rollup_store = rollups.RollupStore(
+    rollups.rollup_store_path,
+    lambda key, plot_info: query_plot_data(key, plot_info),
+    refresh_interval=rollups.ROLLUP_REFRESH_INTERVAL,
+    idle_timeout=rollups.ROLLUP_IDLE_TIMEOUT,
+    leases=shared_backend,
+    owner=worker_id
+) if rollups.ROLLUPS_ENABLED else None
+
+@app.get("/metrics")
+def get_metrics():
+    """Get the query, reflection, tool, LLM, HTTP and cache metrics in the Prometheus text format.
+    """
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """Get the hit, miss and eviction counters of the plot data cache.
+    """
+    return plot_cache.stats()
+
 @app.post("/databases")
 def set_databases_configs(databases: list=Body(...)):
     """Set the databases configuration. This will overwrite the existing configuration.
     Arguments:
     databases: A list of dictionaries with the database configuration.
     """
+    previous = {db["name"]: db["config"] for db in utils.get_databases(databases_config_path)}
     utils.save_databases_info(databases, databases_config_path)
+    current = {db["name"]: db["config"] for db in databases}
+    for name, config in previous.items():
+        if current.get(name) != config:
+            utils.dispose_engine(config)
+            catalog.invalidate(name)
+    # Answers of the agent may refer to the previous databases, only when the AI stack was loaded
+    ai = sys.modules.get("ai")
+    if ai is not None:
+        ai.answer_cache.invalidate()
     return {"message": "Databases configuration updated successfully.","ok":True}
 
 @app.get("/plots/{plot_id}")
 def get_plot(plot_id:str):
-    plot = get_plot_data(plot_id)
+    plot = dict(get_cached_plot_data(plot_id))
     plot.update(get_plot_info(plot_id))
     return plot
 
+def load_plot_data(key:str, plot_info:dict):
+    """Get the data of a plot from the rollup store if it is materialized there, or run its query otherwise.
+    """
+    if rollup_store is not None:
+        data = rollup_store.get(key)
+        if data is not None:
+            return data
+    return query_plot_data(key, plot_info)
+
+def query_plot_data(key:str, plot_info:dict):
+    """Run the query of a plot. This will return the x and y series of the plot.
+    Time series plots are refreshed incrementally from their previous series, with a full refresh every FULL_REFRESH_EVERY refreshes.
+    """
+    previous = plot_cache.peek(key)
+    refreshes = incremental_refreshes.get(key, 0)
+    if refreshes < incremental.FULL_REFRESH_EVERY and incremental.can_refresh_incrementally(plot_info, previous):
+        try:
+            data = incremental.refresh(plot_info, previous)
+            incremental_refreshes[key] = refreshes + 1
+            return data
+        except Exception as e:
+            print(f"Incremental refresh of plot {key} failed, running the full query: {e}")
+    x, y = utils.get_database_class(plot_info["database_configs"]).query_columns(
+        plot_info["query"], [plot_info["x"], plot_info["y"]], limit=plot_info.get("limit")
+    )
+    incremental_refreshes[key] = 0
+    return {"x": x, "y": y}
+
+def encode_arrow(data:dict):
+    """Encode the x and y series of a plot as an Arrow IPC stream. This requires pyarrow.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(status_code=406, detail="Arrow responses require pyarrow to be installed.")
+    with metrics.span("openquerybi_serialization_duration_seconds", format="arrow"):
+        table = pa.table({"x": pa.array(data["x"]), "y": pa.array(data["y"])})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+def get_cached_plot_data(plot_id:str):
+    plot_info = utils.get_plot_info(plot_id)
+    key = utils.get_plot_fingerprint(plot_info)
+    if rollup_store is not None:
+        rollup_store.touch(key)
+    if plot_scheduler.touch(key, plot_info):
+        data = plot_cache.get(key, allow_stale=True)
+        if data is not None:
+            return data
+    return plot_cache.get_or_compute(key, plot_info["update_interval"], lambda: load_plot_data(key, plot_info))
+
 @app.get("/plots/{plot_id}/data")
-def get_plot_data(plot_id:str):
+def get_plot_data(plot_id:str, request:Request, points:Optional[int]=None, resolution:Optional[str]=None, method:str="lttb", format:str="json"):
+    """Get the x and y series of a plot.
+    Arguments:
+    points: The maximum number of points to return. Line plots are reduced with LTTB (or min/max buckets if method is "minmax"), bar plots keep the largest bars plus an "Other" bar.
+    resolution: A pandas frequency (e.g. "1h", "1D") to aggregate time series into before reducing them.
+    method: "lttb" or "minmax".
+    format: "json", or "arrow" for an Arrow IPC stream (also selected by an "Accept: application/vnd.apache.arrow.stream" header).
+    """
+    if format not in ("json", "arrow"):
+        raise HTTPException(status_code=400, detail=f"Unknown format {format!r}, expected json or arrow.")
+    if points or resolution:
+        import downsample
+        if method not in downsample.METHODS:
+            raise HTTPException(status_code=400, detail=f"Unknown method {method!r}, expected lttb or minmax.")
+        if resolution:
+            try:
+                downsample.check_resolution(resolution)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid resolution {resolution!r}, expected a pandas frequency such as 1h or 1D.")
     plot_info = utils.get_plot_info(plot_id)
-    data = utils.get_database_class(plot_info["database_configs"]).query(plot_info["query"])
-    return {
-        "x": [row[plot_info["x"]] for row in data],
-        "y": [row[plot_info["y"]] for row in data]
-    }
+    key = utils.get_plot_fingerprint(plot_info)
+    data = get_cached_plot_data(plot_id)
+    if points or resolution:
+        data = downsample.downsample(data, plot_info["type"], points=points, resolution=resolution, method=method)
+    if format == "arrow" or ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(encode_arrow(data), media_type=ARROW_MEDIA_TYPE)
+    if points or resolution:
+        return Response(encode_json(data), media_type="application/json")
+    # The JSON encoded when the data was cached is reused as the response body
+    return Response(plot_cache.get_encoded(key, data), media_type="application/json")
+
+def format_plot_event(previous:dict, data:dict, mode:str, plot_type:str):
+    """Format a server-sent event with the new data of a plot.
+    In delta mode, line plots send only the points after the longest prefix shared with the previous data.
+    """
+    start = 0
+    if mode == "delta" and previous is not None and plot_type == "line":
+        for start, points in enumerate(zip(previous["x"], previous["y"], data["x"], data["y"])):
+            if points[:2] != points[2:]:
+                break
+        else:
+            start = min(len(previous["x"]), len(data["x"]))
+    if start > 0:
+        event, payload = "delta", {"start": start, "x": data["x"][start:], "y": data["y"][start:]}
+    else:
+        event, payload = "snapshot", data
+    return f"event: {event}\ndata: {json.dumps(payload, default=json_default)}\n\n"
+
+@app.get("/plots/{plot_id}/stream")
+async def stream_plot_data(plot_id:str, mode:str="snapshot"):
+    """Stream the data of a plot as server-sent events. An event is sent only when the data changes.
+    Arguments:
+    mode: "snapshot" to always send the full x and y series, or "delta" to send, for line plots,
+    {"start": n, "x": [...], "y": [...]} meaning "keep the first n points and append these".
+    """
+    plot_info = await asyncio.to_thread(utils.get_plot_info, plot_id)
+    interval = plot_info["update_interval"]
+    key = utils.get_plot_fingerprint(plot_info)
+
+    async def events():
+        sent, queue = None, None
+        try:
+            # Subscribed once the stream is iterated, so that a response cancelled before never leaves a subscriber behind
+            queue = plot_scheduler.subscribe(key, plot_info)
+            data = await asyncio.to_thread(get_cached_plot_data, plot_id)
+            while True:
+                # Open streams keep the rollup of their plot refreshed
+                if rollup_store is not None:
+                    rollup_store.touch(key)
+                if data is not None and data != sent:
+                    yield format_plot_event(sent, data, mode, plot_info["type"])
+                    sent = data
+                try:
+                    data = await asyncio.wait_for(queue.get(), timeout=interval if not plot_scheduler.running else 15)
+                except asyncio.TimeoutError:
+                    if plot_scheduler.running:
+                        data = None
+                        yield ": keepalive\n\n"
+                    else:
+                        data = await asyncio.to_thread(get_cached_plot_data, plot_id)
+        finally:
+            if queue is not None:
+                plot_scheduler.unsubscribe(key, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.get("/plots/{plot_id}/info")
 def get_plot_info(plot_id:str):
@@ -48,12 +284,16 @@ def get_plot_info(plot_id:str):
 class QueryRequest(BaseModel):
     query: str
 
-@app.post("/ai")
 async def get_ai_completion(data: QueryRequest):
     """Get a response from the AI agent.
     Arguments:
     query: The query to send to the AI agent.
     """
-    response = process_query(data.query)
+    # The AI stack is imported on the first request, off the event loop
+    ai = await asyncio.to_thread(importlib.import_module, "ai")
+    response = await ai.aprocess_query(data.query)
     response.pop("input")
-    return response
\ No newline at end of file
+    return response
+
+if API_MODE != "plots":
+    app.post("/ai")(get_ai_completion)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import argparse
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+CATEGORIES = ["Electronics", "Furniture", "Clothing", "Food", "Toys", "Books", "Sports", "Garden"]
+
+def generate(path:str, tables:int=200, rows:int=1000000, seed:int=42, batch_size:int=50000):
+    """Generate a synthetic SQLite database with one large fact table, events, and tables - 1 small dimension tables.
+    The data only depends on the seed, so the database is the same on every run.
+    """
+    random.seed(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(
+        "CREATE TABLE events (id INTEGER PRIMARY KEY, created_at TEXT NOT NULL, category TEXT NOT NULL, "
+        "customer_id INTEGER NOT NULL, quantity INTEGER NOT NULL, amount REAL NOT NULL)"
+    )
+    start = datetime(2024, 1, 1)
+    seconds = 365 * 24 * 3600
+    for offset in range(0, rows, batch_size):
+        count = min(batch_size, rows - offset)
+        conn.executemany(
+            "INSERT INTO events (created_at, category, customer_id, quantity, amount) VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    (start + timedelta(seconds=seconds * row // rows)).isoformat(sep=" "),
+                    random.choice(CATEGORIES), random.randrange(10000), random.randint(1, 10), round(random.uniform(1, 500), 2)
+                )
+                for row in range(offset, offset + count)
+            ]
+        )
+    for table in range(tables - 1):
+        conn.execute(
+            f"CREATE TABLE dim_{table:04d} (id INTEGER PRIMARY KEY, code TEXT NOT NULL, label TEXT, "
+            f"weight REAL, updated_at TEXT)"
+        )
+        conn.executemany(
+            f"INSERT INTO dim_{table:04d} (code, label, weight, updated_at) VALUES (?, ?, ?, ?)",
+            [(f"C{table}-{i}", random.choice(CATEGORIES), random.random(), (start + timedelta(days=i)).date().isoformat()) for i in range(10)]
+        )
+    conn.commit()
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a large synthetic SQLite database for the benchmarks.")
+    parser.add_argument("path")
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generate(args.path, args.tables, args.rows, args.seed)
+    print(f"Generated {args.path} with {args.tables} tables and {args.rows} events")
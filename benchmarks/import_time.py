@@ -0,0 +1,70 @@
+"""Check the import time of the entry modules against a budget, and that they do not import heavy modules they do not need.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 10 --budget api=0.5
+
+Each module is imported in a fresh interpreter, runs times, and the median import time is compared to its budget.
+The script exits with status 1 if a budget is exceeded or a forbidden module is imported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+workspace_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import time budgets in seconds, and modules that must not be imported
+BUDGETS = {
+    "api": {"seconds": 1.0, "forbidden": ["main", "ai", "pandas", "langchain", "langchain_anthropic", "mcp"]},
+    "main": {"seconds": 1.0, "forbidden": ["ai", "pandas", "langchain", "langchain_anthropic"]},
+    "ai": {"seconds": 2.5, "forbidden": ["pandas"]}
+}
+HEAVY_MODULES = ["main", "ai", "pandas", "numpy", "langchain", "langchain_anthropic", "anthropic", "mcp", "sqlglot", "pyarrow"]
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def measure(module:str, runs:int):
+    """Import a module in runs fresh interpreters. This will return the median import time and the heavy modules imported.
+    """
+    times, modules = [], set()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=workspace_path, capture_output=True, text=True, env=dict(os.environ, OPENQUERYBI_SCHEDULER="0")
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+        output = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(output["seconds"])
+        modules.update(output["modules"])
+    return statistics.median(times), sorted(modules)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import time of the OpenQueryBI entry modules.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", action="append", default=[], help="Override a budget, as module=seconds")
+    args = parser.parse_args()
+    for budget in args.budget:
+        module, seconds = budget.split("=")
+        BUDGETS.setdefault(module, {"seconds": 0, "forbidden": []})["seconds"] = float(seconds)
+
+    failures = []
+    for module, budget in BUDGETS.items():
+        seconds, modules = measure(module, args.runs)
+        forbidden = [m for m in modules if m in budget["forbidden"]]
+        status = "ok" if seconds <= budget["seconds"] and not forbidden else "FAIL"
+        print(f"{module:6} {seconds:6.2f} s (budget {budget['seconds']:.2f} s)  imports: {', '.join(modules) or '-'}  {status}")
+        if seconds > budget["seconds"]:
+            failures.append(f"{module} took {seconds:.2f} s")
+        if forbidden:
+            failures.append(f"{module} imported {', '.join(forbidden)}")
+    if failures:
+        print("\n" + "\n".join(failures))
+        sys.exit(1)
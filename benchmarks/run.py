@@ -0,0 +1,281 @@
+"""Benchmark the MCP tools and the plot endpoints against the test databases and a large synthetic database.
+
+    python benchmarks/run.py --concurrency 8 --requests 200
+    python benchmarks/run.py --save-baseline        # store the results as the baseline
+    python benchmarks/run.py --baseline benchmarks/baseline.json
+
+The LLM of the /ai scenario is a local fake, so no API key or network access is needed.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+workspace_path = os.path.dirname(benchmarks_path)
+sys.path.insert(0, workspace_path)
+sys.path.insert(0, benchmarks_path)
+
+import generate_synthetic
+
+# Plots are registered in a temporary registry and are never refreshed in the background
+temp_path = tempfile.mkdtemp(prefix="openquerybi-benchmarks-")
+os.environ.setdefault("OPENQUERYBI_PLOT_REGISTRY", os.path.join(temp_path, "plots.db"))
+os.environ.setdefault("OPENQUERYBI_SCHEDULER", "0")
+os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# (database name, query, x, y)
+FIXTURE_QUERIES = [
+    ("crm", "SELECT Category, SUM(Total_Amount) AS total FROM sales GROUP BY Category", "Category", "total"),
+    ("crm", "SELECT Date, COUNT(*) AS sales FROM sales GROUP BY Date ORDER BY Date", "Date", "sales"),
+    ("crm", "SELECT Department, AVG(Salary) AS salary FROM employees GROUP BY Department", "Department", "salary"),
+    ("inventory", "SELECT location, SUM(quantity) AS quantity FROM inventory GROUP BY location", "location", "quantity"),
+    ("inventory", "SELECT s.company_name, COUNT(*) AS products FROM suppliers s JOIN supplier_products p ON p.supplier_id = s.supplier_id GROUP BY s.company_name", "company_name", "products"),
+]
+SYNTHETIC_QUERIES = [
+    ("synthetic", "SELECT category, SUM(amount) AS amount FROM events GROUP BY category", "category", "amount"),
+    ("synthetic", "SELECT DATE(created_at) AS day, COUNT(*) AS events FROM events GROUP BY DATE(created_at) ORDER BY day", "day", "events"),
+]
+
+class FakeChatModel(BaseChatModel):
+    """Chat model for the structured chat agent that lists the databases once and then answers,
+    after an optional delay standing in for the LLM latency.
+    """
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        if "Observation:" in str(messages[-1].content):
+            action = {"action": "Final Answer", "action_input": "The databases were listed."}
+        else:
+            action = {"action": "list_databases", "action_input": {}}
+        text = f"Action:\n```\n{json.dumps(action)}\n```"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+def percentile(values:list, p:float):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def get_peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024
+
+def measure(name:str, call, requests:int, concurrency:int, warmup:int):
+    """Run call(i) requests times on concurrency threads, after warmup untimed calls.
+    This will return the latency percentiles in milliseconds, the throughput and the peak RSS of the process,
+    which runs a single scenario (see run).
+    """
+    for i in range(warmup):
+        call(i)
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            call(warmup + i)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency * 1000 for latency, error in results]
+    errors = [error for latency, error in results if error is not None]
+    if errors:
+        print(f"{name}: {len(errors)} errors, first: {errors[0]!r}")
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "throughput_rps": requests / elapsed,
+        "peak_rss_mb": get_peak_rss_mb()
+    }
+
+def get_synthetic_path(args):
+    """Generate the synthetic database if needed. This will return its path.
+    """
+    synthetic_path = os.path.join(args.data, f"synthetic_{args.tables}_{args.rows}.db")
+    if not os.path.exists(synthetic_path):
+        os.makedirs(args.data, exist_ok=True)
+        print(f"Generating {synthetic_path}...")
+        generate_synthetic.generate(synthetic_path, args.tables, args.rows)
+    return synthetic_path
+
+def setup(args):
+    """Point the MCP tools and the API to the benchmark databases.
+    """
+    paths = {
+        "crm": os.path.join(workspace_path, "test", "crm.db"),
+        "inventory": os.path.join(workspace_path, "test", "inventory_management.db"),
+        "synthetic": get_synthetic_path(args)
+    }
+    databases = [
+        {"name": name, "config": {"dialect": "sqlite", "database": path}, "tables": [], "type": "sqlite"}
+        for name, path in paths.items()
+    ]
+    import main, api, ai, catalog, utils
+    databases_config_path = os.path.join(temp_path, "databases.json")
+    utils.save_databases_info(databases, databases_config_path)
+    main.databases_config_path = databases_config_path
+    api.databases_config_path = databases_config_path
+    catalog.catalog_path = os.path.join(temp_path, "catalog_cache.json")
+    ai.agent = ai.initialize_agent(
+        ai.tools,
+        FakeChatModel(latency=args.llm_latency / 1000),
+        agent=ai.AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+        return_intermediate_steps=True,
+        agent_kwargs={"prefix": ai.system_prompt + "\n\n" + ai.STRUCTURED_CHAT_PREFIX}
+    )
+    return main, api
+
+# The _uncached scenarios replay the same queries with the tool cache disabled or the plot cache invalidated
+# before each request, so that they time the query path instead of cache hits
+SCENARIOS = ["get_databases", "validate_query", "validate_query_uncached", "plot_from_sql", "plot_data", "plot_data_uncached", "ai"]
+
+def run_scenario(args, name:str):
+    """Run one scenario in this process. This will return its measurements.
+    """
+    main, api = setup(args)
+    import utils
+    from fastapi.testclient import TestClient
+    client = TestClient(api.app)
+    queries = FIXTURE_QUERIES + SYNTHETIC_QUERIES
+    plot_ids = [
+        main.plot_from_sql("bar", database_name, query, x, y, title="Benchmark")["plot_id"]
+        for database_name, query, x, y in queries
+    ]
+    plot_keys = [utils.get_plot_fingerprint(utils.get_plot_info(plot_id)) for plot_id in plot_ids]
+
+    def get_plot_data(i):
+        response = client.get(f"/plots/{plot_ids[i % len(plot_ids)]}/data")
+        response.raise_for_status()
+
+    def get_uncached_plot_data(i):
+        api.plot_cache.invalidate(plot_keys[i % len(plot_keys)])
+        get_plot_data(i)
+
+    def ask(i):
+        response = client.post("/ai", json={"query": f"Which databases are available? ({i})"})
+        response.raise_for_status()
+
+    def create_plot(i):
+        database_name, query, x, y = queries[i % len(queries)]
+        main.plot_from_sql("bar", database_name, query, x, y, title=f"Benchmark {i}")
+
+    if name == "validate_query_uncached":
+        main.TOOL_CACHE_TTL = 0
+    scenarios = {
+        "get_databases": lambda i: main.get_databases(),
+        "validate_query": lambda i: main.validate_query(*queries[i % len(queries)][:2]),
+        "validate_query_uncached": lambda i: main.validate_query(*queries[i % len(queries)][:2]),
+        "plot_from_sql": create_plot,
+        "plot_data": get_plot_data,
+        "plot_data_uncached": get_uncached_plot_data,
+        "ai": ask
+    }
+    return measure(name, scenarios[name], args.requests, args.concurrency, args.warmup)
+
+def run(args):
+    """Run each scenario in its own process, so that its peak RSS is not inherited from the previous scenarios.
+    """
+    get_synthetic_path(args)
+    options = [
+        "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--warmup", str(args.warmup),
+        "--tables", str(args.tables), "--rows", str(args.rows), "--llm-latency", str(args.llm_latency), "--data", args.data
+    ]
+    results = {}
+    for name in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name] + options, capture_output=True, text=True)
+        lines = child.stdout.strip().splitlines()
+        if child.returncode != 0 or not lines:
+            raise RuntimeError(f"Scenario {name} failed:\n{child.stdout}{child.stderr}")
+        for line in lines[:-1]:
+            print(line)
+        results[name] = json.loads(lines[-1])
+        print(
+            f"{name:23} p50 {results[name]['p50_ms']:9.2f} ms  p95 {results[name]['p95_ms']:9.2f} ms  "
+            f"p99 {results[name]['p99_ms']:9.2f} ms  {results[name]['throughput_rps']:9.1f} req/s  "
+            f"peak RSS {results[name]['peak_rss_mb']:7.1f} MB"
+        )
+    return results
+
+def compare(results:dict, baseline:dict, tolerance:float):
+    """Print the change of each metric against the baseline.
+    This will return the list of scenarios whose p95 latency or throughput regressed by more than tolerance.
+    """
+    regressions = []
+    print("\nChange against the baseline:")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        latency = result["p95_ms"] / previous["p95_ms"] - 1
+        throughput = result["throughput_rps"] / previous["throughput_rps"] - 1
+        print(
+            f"{name:23} p50 {result['p50_ms'] / previous['p50_ms'] - 1:+7.1%}  p95 {latency:+7.1%}  "
+            f"p99 {result['p99_ms'] / previous['p99_ms'] - 1:+7.1%}  throughput {throughput:+7.1%}  "
+            f"peak RSS {result['peak_rss_mb'] / previous['peak_rss_mb'] - 1:+7.1%}"
+        )
+        if latency > tolerance or throughput < -tolerance:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OpenQueryBI tools and plot endpoints.")
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--tables", type=int, default=200, help="Tables of the synthetic database")
+    parser.add_argument("--rows", type=int, default=1000000, help="Rows of the synthetic events table")
+    parser.add_argument("--llm-latency", type=float, default=0, help="Latency of the fake LLM, in milliseconds")
+    parser.add_argument("--data", default=os.path.join(benchmarks_path, "data"), help="Directory of the generated databases")
+    parser.add_argument("--scenarios", nargs="*", help="Scenarios to run, all by default")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=os.path.join(benchmarks_path, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 latency and throughput regression")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        try:
+            print(json.dumps(run_scenario(args, args.child)))
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        sys.exit(0)
+    try:
+        results = run(args)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nRegressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
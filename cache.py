@@ -0,0 +1,148 @@
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from decimal import Decimal
+import metrics
+
+def json_default(value):
+    """Encode the values that json does not support the way FastAPI does: decimals as numbers,
+    dates and times as ISO 8601 strings, durations as seconds and anything else as a string.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return str(value)
+
+def encode_json(value):
+    """Encode a value as compact JSON bytes, the body of the plot data responses.
+    """
+    with metrics.span("openquerybi_serialization_duration_seconds", format="json"):
+        return json.dumps(value, separators=(",", ":"), default=json_default).encode()
+
+class ResultCache():
+    """In-memory LRU cache of query results with a per-entry time to live.
+    Each value is encoded to JSON once when it is cached (see get_encoded), and memory is bounded by the number
+    of entries and by the size of their encodings.
+    Concurrent misses on the same key are collapsed into a single computation.
+    """
+    def __init__(self, max_entries:int=1024, max_bytes:int=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key, allow_stale:bool=False):
+        """Get a cached value. This will return None if the key is missing or expired, unless allow_stale is True.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (not allow_stale and entry["expires_at"] <= time.monotonic()):
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def peek(self, key):
+        """Get a cached value even if it expired, without counting a hit or refreshing its LRU position.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry["value"]
+
+    def set(self, key, value, ttl:float):
+        with self.lock:
+            entry = self.entries.get(key)
+            encoded = entry["encoded"] if entry is not None and entry["value"] is value else None
+        if encoded is None:
+            encoded = encode_json(value)
+        with self.lock:
+            self._remove(key)
+            if len(encoded) > self.max_bytes:
+                return
+            self.entries[key] = {"value": value, "encoded": encoded, "expires_at": time.monotonic() + ttl, "size": len(encoded)}
+            self.size += len(encoded)
+            self._evict()
+
+    def get_encoded(self, key, value):
+        """Get the JSON encoding of a value, reusing the one kept in the cache entry of key if value is its cached value.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["value"] is value:
+                return entry["encoded"]
+        return encode_json(value)
+
+    def get_or_compute(self, key, ttl:float, compute, force:bool=False):
+        """Get a fresh cached value, or compute and cache it. If force is True, the value is always recomputed.
+        If another thread is already computing the same key, this waits for its result instead of computing it again.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if not force and entry is not None and entry["expires_at"] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["value"]
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+            self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def invalidate(self, key=None):
+        """Drop a cached value, or every cached value if no key is given.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions
+            }
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry["size"]
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import utils
+
+CATALOG_TTL = int(os.getenv("OPENQUERYBI_CATALOG_TTL", "3600"))
+SAMPLE_ROWS = 3
+INTROSPECTION_WORKERS = int(os.getenv("OPENQUERYBI_INTROSPECTION_WORKERS", "16"))
+INTROSPECTION_CONCURRENCY = int(os.getenv("OPENQUERYBI_INTROSPECTION_CONCURRENCY", "4"))
+INTROSPECTION_TIMEOUT = float(os.getenv("OPENQUERYBI_INTROSPECTION_TIMEOUT", "30"))
+
+workspace_path = os.path.dirname(os.path.abspath(__file__))
+catalog_path = os.path.join(workspace_path, "catalog_cache.json")
+
+_catalogs = None
+_lock = threading.Lock()
+_builds = {}
+_database_pool = ThreadPoolExecutor(max_workers=INTROSPECTION_WORKERS, thread_name_prefix="catalog")
+_introspection_slots = threading.BoundedSemaphore(INTROSPECTION_WORKERS)
+
+def _load_catalogs():
+    global _catalogs
+    if _catalogs is None:
+        try:
+            with open(catalog_path, "r") as f:
+                _catalogs = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _catalogs = {}
+    return _catalogs
+
+def _save_catalogs():
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_catalogs, f)
+    os.replace(tmp_path, catalog_path)
+
+def get_config_key(config:dict):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def _get_sample(Database:utils.Database, table:str):
+    with _introspection_slots:
+        try:
+            return Database.get_sample_rows(table=table, limit=SAMPLE_ROWS, format=True)
+        except Exception as e:
+            return f"/*\nSample rows unavailable: {e}\n*/"
+
+def build_catalog(config:dict, fingerprint:str):
+    """Reflect the schema of a database and read sample rows of each table.
+    Sample rows are read in parallel, with at most config["max_concurrency"] queries at a time on the database.
+    """
+    Database = utils.get_database_class(config)
+    with _introspection_slots:
+        schemas = Database.export_schema_as_sql()
+    ddls = [item for d in schemas for item in d.items()]
+    with ThreadPoolExecutor(max_workers=int(config.get("max_concurrency") or INTROSPECTION_CONCURRENCY)) as pool:
+        samples = list(pool.map(lambda item: _get_sample(Database, item[0]), ddls))
+    tables = [{"name": k, "ddl": v, "sample": sample} for (k, v), sample in zip(ddls, samples)]
+    return {
+        "config_key": get_config_key(config),
+        "fingerprint": fingerprint,
+        "created_at": time.time(),
+        "tables": tables
+    }
+
+def is_fresh(entry:dict, config:dict, fingerprint:str):
+    return (
+        entry is not None
+        and entry["config_key"] == get_config_key(config)
+        and entry["fingerprint"] == fingerprint
+        and time.time() - entry["created_at"] < CATALOG_TTL
+    )
+
+def get_catalog(database_name:str, config:dict, refresh:bool=False):
+    """Get the cached schema and sample rows of a database.
+    The cache is rebuilt when the schema fingerprint or the config changes, when the entry is older than CATALOG_TTL seconds or when refresh is True.
+    """
+    fingerprint = utils.get_database_class(config).get_schema_fingerprint()
+    with _lock:
+        entry = _load_catalogs().get(database_name)
+    if not refresh and is_fresh(entry, config, fingerprint):
+        return entry
+    entry = build_catalog(config, fingerprint)
+    with _lock:
+        _load_catalogs()[database_name] = entry
+        _save_catalogs()
+    return entry
+
+def get_catalogs(databases:list, timeout:float=INTROSPECTION_TIMEOUT):
+    """Get the catalogs of several databases in parallel.
+    This will return a dict with the catalog of each database, or the exception raised while reading it.
+    Databases that are not ready after timeout seconds are mapped to None; their catalog keeps loading in the background.
+    """
+    futures = {}
+    with _lock:
+        for db in databases:
+            name = db["name"]
+            future = _builds.get(name)
+            if future is None or future.done():
+                future = _database_pool.submit(get_catalog, name, db["config"])
+                _builds[name] = future
+                future.add_done_callback(lambda f, name=name: _builds.pop(name) if _builds.get(name) is f else None)
+            futures[name] = future
+    wait(list(futures.values()), timeout=timeout)
+    catalogs = {}
+    for name, future in futures.items():
+        if not future.done():
+            catalogs[name] = None
+        elif future.exception() is not None:
+            catalogs[name] = future.exception()
+        else:
+            catalogs[name] = future.result()
+    return catalogs
+
+def invalidate(database_name:str=None):
+    """Drop the cached catalog of a database, or of every database if no name is given.
+    """
+    with _lock:
+        catalogs = _load_catalogs()
+        if database_name is None:
+            catalogs.clear()
+        else:
+            catalogs.pop(database_name, None)
+        _save_catalogs()
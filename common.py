@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+import threading
+
+class SQLiteStore():
+    """Base of the local SQLite files shared by the threads and processes of the server (plot registry, rollups,
+    shared cache). Each thread gets its own connection, in WAL mode and waiting up to 30 seconds for locks.
+    """
+    # sqlite3 transaction handling of the connections, None for autocommit
+    isolation_level = ""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=self.isolation_level)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self.local.conn = conn
+        return conn
+
+class BackgroundTask():
+    """Base of the objects that run their run coroutine as an asyncio task, from start until stop.
+    """
+    task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        raise NotImplementedError
@@ -0,0 +1,111 @@
+import datetime
+import warnings
+import numpy as np
+import pandas as pd
+
+def _to_datetime(x:list):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return pd.to_datetime(pd.Series(x), errors="coerce")
+
+METHODS = ("lttb", "minmax")
+
+def check_resolution(resolution:str):
+    """Make sure resolution is a pandas frequency. This will raise ValueError otherwise.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        pd.tseries.frequencies.to_offset(resolution)
+
+def resample(x:list, y:list, resolution:str, how:str="mean"):
+    """Aggregate a time series into buckets of a pandas frequency (e.g. "1h", "1D", "1W").
+    The series is returned unchanged if x is not a date/time column: only strings, dates and datetimes are resampled,
+    numbers (e.g. years) are not read as epoch timestamps.
+    """
+    if not all(isinstance(value, (str, datetime.date)) for value in x):
+        return x, y
+    index = _to_datetime(x)
+    if len(index) == 0 or index.isna().any():
+        return x, y
+    series = pd.Series(pd.to_numeric(pd.Series(y), errors="coerce").to_numpy(), index=index.to_numpy())
+    series = getattr(series.resample(resolution), how)().dropna()
+    return [t.isoformat() for t in series.index], series.tolist()
+
+def _positions(x:list):
+    """Get numeric positions of the x values, falling back to row order for non numeric x."""
+    positions = pd.to_numeric(pd.Series(x), errors="coerce")
+    if positions.isna().any():
+        positions = _to_datetime(x)
+        if positions.isna().any():
+            return np.arange(len(x), dtype=float)
+        positions = positions.astype("int64")
+    return positions.to_numpy(dtype=float)
+
+def lttb(x:list, y:list, points:int):
+    """Downsample a line series to points points with the Largest-Triangle-Three-Buckets algorithm.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return x, y
+    px, py = _positions(x), np.asarray(y, dtype=float)
+    py = np.where(np.isnan(py), 0.0, py)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    selected = np.empty(points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = px[end:next_end].mean(), py[end:next_end].mean()
+        areas = np.abs((px[a] - avg_x) * (py[start:end] - py[a]) - (px[a] - px[start:end]) * (avg_y - py[a]))
+        a = start + int(areas.argmax())
+        selected[i + 1] = a
+    return [x[i] for i in selected], [y[i] for i in selected]
+
+def minmax(x:list, y:list, points:int):
+    """Downsample a line series keeping the minimum and maximum of each of points/2 buckets.
+    """
+    n = len(x)
+    buckets = points // 2
+    if points >= n or buckets < 1:
+        return x, y
+    size = -(-n // buckets)
+    values = np.full(buckets * size, np.nan)
+    values[:n] = np.asarray(y, dtype=float)
+    values = values.reshape(buckets, size)
+    valid = ~np.isnan(values).all(axis=1)
+    offsets = np.arange(buckets)[valid] * size
+    filled = values[valid]
+    lows = offsets + np.nanargmin(filled, axis=1)
+    highs = offsets + np.nanargmax(filled, axis=1)
+    selected = np.unique(np.concatenate([lows, highs]))
+    return [x[i] for i in selected], [y[i] for i in selected]
+
+def top_n(x:list, y:list, points:int, other:str="Other"):
+    """Keep the points-1 largest bars and sum the remaining ones into a single "Other" bar, keeping the original order.
+    """
+    n = len(x)
+    if points >= n or points < 2:
+        return x, y
+    values = np.nan_to_num(np.asarray(y, dtype=float))
+    keep = np.sort(np.argsort(-values, kind="stable")[:points - 1])
+    rest = np.ones(n, dtype=bool)
+    rest[keep] = False
+    return [x[i] for i in keep] + [other], [y[i] for i in keep] + [float(values[rest].sum())]
+
+def downsample(data:dict, plot_type:str, points:int=None, resolution:str=None, method:str="lttb"):
+    """Reduce the x and y series of a plot for display.
+    Line plots are resampled to resolution (if given) and then reduced to points points with LTTB or min/max buckets.
+    Bar plots keep the top points bars plus an "Other" bar.
+    """
+    x, y = data["x"], data["y"]
+    if resolution:
+        x, y = resample(x, y, resolution, how="sum" if plot_type == "bar" else "mean")
+    if points:
+        if plot_type == "bar":
+            x, y = top_n(x, y, points)
+        elif method == "minmax":
+            x, y = minmax(x, y, points)
+        else:
+            x, y = lttb(x, y, points)
+    return {"x": x, "y": y}
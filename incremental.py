@@ -0,0 +1,121 @@
+import datetime
+import os
+from bisect import bisect_left
+import sqlglot
+from sqlglot import exp
+import utils
+import query_guard
+
+INCREMENTAL_OVERLAP = int(os.getenv("OPENQUERYBI_INCREMENTAL_OVERLAP", "1"))
+FULL_REFRESH_EVERY = int(os.getenv("OPENQUERYBI_INCREMENTAL_FULL_REFRESH_EVERY", "30"))
+
+def is_monotonic(values:list):
+    try:
+        return all(a <= b for a, b in zip(values, values[1:]))
+    except TypeError:
+        return False
+
+def is_temporal(values:list):
+    """Check if values are dates or datetimes, as date/datetime objects or ISO 8601 strings.
+    """
+    for value in values:
+        if isinstance(value, str):
+            try:
+                datetime.datetime.fromisoformat(value)
+            except ValueError:
+                return False
+        elif not isinstance(value, datetime.date):
+            return False
+    return True
+
+def can_refresh_incrementally(plot_info:dict, previous:dict):
+    """Check if a plot can be refreshed from the previous series instead of re-running its full query.
+    This requires a line plot whose previous x values are sorted dates or datetimes, and that did not reach its row limit.
+    """
+    return (
+        plot_info.get("incremental", True)
+        and plot_info["type"] == "line"
+        and previous is not None
+        and len(previous["x"]) > 0
+        and (not plot_info.get("limit") or len(previous["x"]) < plot_info["limit"])
+        and is_monotonic(previous["x"])
+        and is_temporal(previous["x"])
+    )
+
+def get_truncated_column(expression:exp.Expression):
+    """Get the column truncated by an x expression such as DATE(column), date_trunc('day', column) or column::date.
+    Since the watermark is itself a truncated value, "expression >= watermark" then holds exactly when
+    "column >= watermark" does, and the latter can use an index on the column. This will return None otherwise.
+    """
+    if isinstance(expression, exp.Column):
+        return expression
+    if isinstance(expression, (exp.Date, exp.DateTrunc, exp.TimestampTrunc)) and isinstance(expression.this, exp.Column):
+        if all(not value or key in ("this", "unit") for key, value in expression.args.items()):
+            return expression.this
+    if isinstance(expression, exp.Cast) and expression.to.is_type("date") and isinstance(expression.this, exp.Column):
+        return expression.this
+    return None
+
+def push_watermark(query:str, x:str, dialect:str):
+    """Add "x >= :watermark" to the WHERE clause of a plot query, on the column x is computed from when possible.
+    This requires a single SELECT without LIMIT or window functions whose x is a column, or a group key when the query
+    aggregates. This will return the new query, or None if the predicate cannot be pushed down.
+    """
+    read = query_guard.SQLGLOT_DIALECTS.get(dialect)
+    try:
+        statement = sqlglot.parse_one(query, read=read)
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(statement, exp.Select) or statement.args.get("limit") or statement.args.get("offset") or statement.find(exp.Window):
+        return None
+    projections = [projection for projection in statement.expressions if projection.alias_or_name == x]
+    if len(projections) != 1:
+        return None
+    position, expression = statement.expressions.index(projections[0]) + 1, projections[0].unalias()
+    if expression.find(exp.AggFunc):
+        return None
+    group = statement.args.get("group")
+    if group is not None:
+        keys = [
+            key for key in group.expressions
+            if key == expression
+            or (isinstance(key, exp.Column) and not key.table and key.name == x)
+            or (isinstance(key, exp.Literal) and not key.is_string and key.this == str(position))
+        ]
+        if not keys:
+            return None
+    elif statement.find(exp.AggFunc):
+        return None
+    target = get_truncated_column(expression) or expression
+    watermark = exp.Placeholder(this="watermark")
+    sql = statement.where(exp.GTE(this=target.copy(), expression=watermark)).sql(dialect=read)
+    return sql.replace(watermark.sql(dialect=read), ":watermark")
+
+def refresh(plot_info:dict, previous:dict):
+    """Re-query only the points of a plot from the watermark on, and merge them into the previous series.
+    The watermark is the x value of the last incremental_overlap points, so that late data in the latest buckets is picked up.
+    The watermark predicate is pushed into the WHERE clause of the plot query (see push_watermark), so that the database
+    only reads the rows of the new buckets; the outer filter keeps the result exact when it cannot be.
+    """
+    overlap = max(int(plot_info.get("incremental_overlap", INCREMENTAL_OVERLAP)), 1)
+    watermark = previous["x"][max(len(previous["x"]) - overlap, 0)]
+    source = plot_info["query"].strip().rstrip(";")
+    source = push_watermark(source, plot_info["x"], plot_info["database_configs"]["dialect"]) or source
+    column = '"' + plot_info["x"].replace('"', '""') + '"'
+    query = (
+        f"SELECT * FROM ({source}) AS incremental_source "
+        f"WHERE {column} >= :watermark ORDER BY {column}"
+    )
+    x, y = utils.get_database_class(plot_info["database_configs"]).query_columns(
+        query, [plot_info["x"], plot_info["y"]], params={"watermark": watermark}
+    )
+    return merge(previous, x, y, watermark, plot_info.get("limit"))
+
+def merge(previous:dict, x:list, y:list, watermark, limit:int=None):
+    """Replace the points of the previous series from the watermark on with the new points.
+    """
+    cut = bisect_left(previous["x"], watermark)
+    data = {"x": previous["x"][:cut] + x, "y": previous["y"][:cut] + y}
+    if limit:
+        data = {"x": data["x"][:limit], "y": data["y"][:limit]}
+    return data
@@ -1,55 +1,165 @@
-import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import os
+import functools
 import utils
+import catalog
+import plot_registry
+import query_guard
+import metrics
+from cache import ResultCache
+from schema_index import SchemaIndex
 from mcp.server.fastmcp import FastMCP
-import json
 
 PORT = 8002
+MAX_PREVIEW_ROWS = int(os.getenv("OPENQUERYBI_MAX_PREVIEW_ROWS", "1000"))
+MAX_PREVIEW_BYTES = int(os.getenv("OPENQUERYBI_MAX_PREVIEW_BYTES", str(256*1024)))
+COUNT_SCAN_ROWS = int(os.getenv("OPENQUERYBI_COUNT_SCAN_ROWS", "10000"))
+# Dialects whose previews are wrapped in SELECT * FROM (...) LIMIT n, which keeps the order of the inner query
+PREVIEW_LIMIT_DIALECTS = ("sqlite", "postgresql")
 
-workspace_path = os.path.dirname(os.path.abspath(__file__))
-databases_config_path = os.path.join(workspace_path, "databases.json")
+databases_config_path = utils.databases_config_path
+
+# Results of validate_query, keyed by database, schema fingerprint, normalized SQL and limit
+TOOL_CACHE_TTL = float(os.getenv("OPENQUERYBI_TOOL_CACHE_TTL", "60"))
+tool_cache = ResultCache(max_entries=int(os.getenv("OPENQUERYBI_TOOL_CACHE_ENTRIES", "512")), max_bytes=16*1024*1024)
+metrics.register_cache("tool", tool_cache)
+# Schema fingerprints used in the tool cache keys, re-read at most every SCHEMA_FINGERPRINT_TTL seconds per database
+SCHEMA_FINGERPRINT_TTL = float(os.getenv("OPENQUERYBI_SCHEMA_FINGERPRINT_TTL", "10"))
+schema_fingerprints = ResultCache(max_entries=256)
+
+SCHEMA_PROMPT_MAX_TABLES = int(os.getenv("OPENQUERYBI_SCHEMA_PROMPT_MAX_TABLES", "50"))
+schema_index = SchemaIndex()
 
 mcp = FastMCP("OpenQueryBI",host="0.0.0.0", port=PORT)
 
+def async_tool(function):
+    """Register a blocking function as an async MCP tool, run on the database executor.
+    The function is returned timed but otherwise unchanged, so it can still be called synchronously (by the agent tools).
+    """
+    function = metrics.timed("openquerybi_tool_duration_seconds", tool=function.__name__)(function)
+    @functools.wraps(function)
+    async def tool(*args, **kwargs):
+        return await utils.run_blocking(function, *args, **kwargs)
+    mcp.tool()(tool)
+    return function
+
 def __query(query: str, database_info:dict):
-   
-    if database_info['dialect'] == "sqlite":
-        connection_url = f"sqlite:///{database_info['database']}"
-    
-    elif database_info['dialect'] == "postgresql":
-        connection_url = (
-        f"postgresql://{database_info['username']}:{database_info['password']}"
-        f"@{database_info['host']}/{database_info['database']}"
-        f"?sslmode={database_info.get('sslmode','require')}&channel_binding={database_info.get('channel_binding','require')}"
-    )
-
-    else:
-       connection_url = (
-        f"{database_info['dialect']}://{database_info['username']}:{database_info['password']}"
-        f"@{database_info['host']}:{database_info['port']}/{database_info['database']}"
-    )
-    engine = create_engine(connection_url)
-    with engine.connect() as conn:
+    engine = utils.get_engine(database_info)
+    with metrics.query_span(database_info, "mcp_query", query) as span, engine.connect() as conn:
         result = conn.execute(text(query))
-        return result.fetchall(),list(result.keys())
+        rows = result.fetchall()
+        span["rows"] = len(rows)
+        return rows,list(result.keys())
 
-@mcp.tool()
+def __query_preview(query: str, database_info:dict, max_rows:int, max_bytes:int, batch_size:int=500):
+    """Run a query with a server-side cursor, keeping at most max_rows rows and about max_bytes bytes of values.
+    When the result is truncated, up to COUNT_SCAN_ROWS more rows are counted (not kept) to estimate its size.
+    This will return the kept rows, the column names, the number of rows seen and whether the whole result was seen.
+    On SQLite and Postgres the query is wrapped in a LIMIT of the rows read, so that the database can stop early
+    (e.g. keep only the top rows of an ORDER BY instead of sorting the whole result).
+    """
+    if database_info["dialect"] in PREVIEW_LIMIT_DIALECTS:
+        query = f"SELECT * FROM ({query.strip().rstrip(';')}) AS preview LIMIT {max_rows + COUNT_SCAN_ROWS + 1}"
+    engine = utils.get_engine(database_info)
+    with metrics.query_span(database_info, "preview", query) as span, engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(text(query))
+        columns = list(result.keys())
+        rows, size, seen, complete = [], 0, 0, True
+        for batch in result.partitions(batch_size):
+            seen += len(batch)
+            for row in batch:
+                size += sum(len(str(value)) for value in row)
+                if len(rows) >= max_rows or size > max_bytes:
+                    complete = False
+                    break
+                rows.append(row)
+            if not complete:
+                break
+        if not complete:
+            for batch in result.partitions(batch_size):
+                seen += len(batch)
+                if seen >= max_rows + COUNT_SCAN_ROWS:
+                    break
+            else:
+                complete = True
+        if seen > max_rows + COUNT_SCAN_ROWS:
+            seen, complete = max_rows + COUNT_SCAN_ROWS, False
+        result.close()
+        span["rows"] = seen
+        return rows, columns, seen, complete
+
+@async_tool
 def get_databases():
     """Get the list of all the databases. This will return a list of dictionaries with the name and description of each database.
     """
     databases = utils.get_databases(databases_config_path)
+    catalogs = catalog.get_catalogs(databases)
+    index_catalogs(catalogs)
+    table_count = sum(len(entry["tables"]) for entry in catalogs.values() if isinstance(entry, dict))
+    output = "Databases available:\n"
+    if table_count > SCHEMA_PROMPT_MAX_TABLES:
+        output += "Only table names are listed. Use search_tables to get the CREATE TABLE statements and sample rows of the tables relevant to the question.\n"
     for db in databases:
-        Database = utils.get_database_class(db["config"])
-        schemas = Database.export_schema_as_sql()
+        entry = catalogs[db["name"]]
+        if entry is None:
+            output += f"\n    Database Name: {db['name']}\n    Schema still loading, try again later.\n####\n"
+            continue
+        if isinstance(entry, Exception):
+            output += f"\n    Database Name: {db['name']}\n    Unavailable: {entry}\n####\n"
+            continue
+        if table_count > SCHEMA_PROMPT_MAX_TABLES:
+            output += f"\n    Database Name: {db['name']}\n    Type: {db['type']}\n    Tables: {', '.join(table['name'] for table in entry['tables'])}\n####\n"
+            continue
         for attr in ["tables","config"]:
             db.pop(attr)
-        db['tables'] = [{v:Database.get_sample_rows(table=k,limit=3,format=True)} for d in schemas for k, v in d.items()]
-    output = "Databases available:\n"
-    for db in databases:
+        db['tables'] = [{table["ddl"]:table["sample"]} for table in entry["tables"]]
         output += utils.get_database_prompt(db)+"\n####\n"
     return output
 
+def index_catalogs(catalogs:dict):
+    """Update the schema index with the tables of the catalogs that could be read.
+    """
+    for database_name, entry in catalogs.items():
+        if isinstance(entry, dict):
+            schema_index.update(database_name, entry["tables"])
+
+@async_tool
+def search_tables(question:str, top_k:int=5, database_name:str=""):
+    """Search the tables relevant to a question. This will return the CREATE TABLE statement and sample rows of the top_k best matching tables.
+    Use this instead of get_databases when there are many tables, with the words of the user's question and the names of the entities involved.
+    Arguments:
+    question: The question or keywords to search for.
+    top_k: The maximum number of tables to return. Default is 5.
+    database_name: The name of the database to search in. Leave empty to search all the databases.
+    """
+    databases = utils.get_databases(databases_config_path)
+    for name in schema_index.database_names() - {db["name"] for db in databases}:
+        schema_index.remove_database(name)
+    if database_name:
+        databases = [db for db in databases if db["name"] == database_name]
+    index_catalogs(catalog.get_catalogs(databases))
+    results = schema_index.search(question, top_k=top_k, database_name=database_name or None)
+    if not results:
+        return "No table matches the question."
+    output = "Relevant tables:\n"
+    for score, database, table in results:
+        output += f"\nDatabase Name: {database}\n{table['ddl']}{table['sample']}\n"
+    return output
+
+@async_tool
+def refresh_databases_catalog(database_name:str=""):
+    """Refresh the cached schema and sample rows returned by get_databases.
+    Use this only if the database schema changed and get_databases looks outdated.
+    Arguments:
+    database_name: The name of the database to refresh. Leave empty to refresh all the databases.
+    """
+    databases = utils.get_databases(databases_config_path)
+    if database_name:
+        databases = [utils.get_database_info(database_name, databases_config_path)]
+    for db in databases:
+        catalog.get_catalog(db["name"], db["config"], refresh=True)
+    return f"Catalog refreshed for: {', '.join(db['name'] for db in databases)}"
+
 def get_tables(database_name:str):
     """Get the list of all the tables in the database. This will return a list of dictionaries with the name and description of each table.
     """
@@ -66,7 +176,18 @@ def get_table_columns(database_name:str, table:str):
     columns = database.get_table_columns(table)
     return ", ".join(columns)
 
-@mcp.tool()
+def get_schema_fingerprint(config:dict):
+    """Get the schema fingerprint of a database, cached for SCHEMA_FINGERPRINT_TTL seconds.
+    This will return None if the dialect has no schema fingerprint.
+    """
+    def compute():
+        try:
+            return utils.get_database_class(config).get_schema_fingerprint()
+        except ValueError:
+            return None
+    return schema_fingerprints.get_or_compute(catalog.get_config_key(config), SCHEMA_FINGERPRINT_TTL, compute)
+
+@async_tool
 def validate_query(database_name: str, query: str, limit: int = 100):
     """Query a table in the database. This will return the result of the query.
     Run this function carefully. This will execute the query in the database.
@@ -77,13 +198,27 @@ def validate_query(database_name: str, query: str, limit: int = 100):
     database_name: The name of the database to use.
     query: The SQL query to execute.""" 
     database_info = utils.get_database_info(database_name, databases_config_path)
-    if "limit" not in query.lower():
-        query = f"{query} LIMIT {limit}"
-    data,columns = __query(query,database_info["config"])
-    return pd.DataFrame(data, columns=columns).to_string(index=False)
+    fingerprint = get_schema_fingerprint(database_info["config"])
+    def compute():
+        query_guard.check_query(query, database_info["config"])
+        return __preview_query(query, database_info["config"], limit)
+    if fingerprint is None:
+        return compute()
+    key = (database_name, catalog.get_config_key(database_info["config"]), fingerprint, utils.normalize_query(query), limit)
+    return tool_cache.get_or_compute(key, TOOL_CACHE_TTL, compute)
+
+def __preview_query(query: str, database_info:dict, limit:int):
+    data, columns, seen, complete = __query_preview(query, database_info, min(limit, MAX_PREVIEW_ROWS), MAX_PREVIEW_BYTES)
+    import pandas as pd
+    with metrics.span("openquerybi_dataframe_duration_seconds"):
+        output = pd.DataFrame(data, columns=columns).to_string(index=False)
+    if len(data) < seen:
+        total = f"{seen}" if complete else f"more than {seen}"
+        output += f"\n({len(data)} rows shown, the query returned {total} rows)"
+    return output
 
-@mcp.tool()
-def plot_from_sql(type:str,database_name:str,query:str,x:str,y:str,limit:int=100, update_interval:int=10, title:str="Graph requested to AI"):
+@async_tool
+def plot_from_sql(type:str,database_name:str,query:str,x:str,y:str,limit:int=100, update_interval:int=10, title:str="Graph requested to AI", incremental:bool=True):
     """Plot a line chart from a SQL query. This will create a line chart with the x and y values.
     Please be sure that the query is working. Validate the query using the query_table function before calling this function.
     The query must return a table with the x and y values. The x and y values must be in the same table.
@@ -97,10 +232,10 @@ def plot_from_sql(type:str,database_name:str,query:str,x:str,y:str,limit:int=100
     limit: The maximum number of rows to return from the query. Default is 100 rows,
     update_interval: The interval in seconds to update the graph. Default is 180 seconds,
     title: The title of the graph. Default is "Graph requested to AI".
+    incremental: Refresh a line plot whose x values are dates or datetimes by querying only its newest rows. Default is True.
     """
     database_info = utils.get_database_info(database_name, databases_config_path)
-    with open(os.path.join(workspace_path, "plot_info.json"), "r") as f:
-        plots = json.load(f)
+    query_guard.check_query(query, database_info["config"])
     plot_data = {
     "type":type,
     "database_configs": database_info["config"],
@@ -111,11 +246,11 @@ def plot_from_sql(type:str,database_name:str,query:str,x:str,y:str,limit:int=100
     "update_interval": update_interval,
     "title": title
     }
+    if not incremental:
+        plot_data["incremental"] = False
+    plot_data["fingerprint"] = utils.get_plot_fingerprint(plot_data)
     plot_id = utils.generate_plot_id(plot_data)
-    if plot_id not in plots:
-        plots[plot_id] = plot_data
-        with open(os.path.join(workspace_path, "plot_info.json"), "w") as f:
-            json.dump(plots, f, indent=4)
+    plot_registry.get_registry().add(plot_id, plot_data)
     return {
         'plot_id': plot_id,
         'message': f'Plot created with id {plot_id}, This plot will be visible in the UI.'
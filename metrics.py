@@ -0,0 +1,169 @@
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# Queries slower than this many seconds are logged, 0 disables the slow query log
+SLOW_QUERY_SECONDS = float(os.getenv("OPENQUERYBI_SLOW_QUERY_SECONDS", "0"))
+# File the slow queries are appended to as JSON lines, they are printed when not set
+SLOW_QUERY_LOG = os.getenv("OPENQUERYBI_SLOW_QUERY_LOG")
+
+_lock = threading.Lock()
+_metrics = {}
+_caches = {}
+
+HELP = {
+    "openquerybi_query_duration_seconds": "Duration of the SQL queries, by database and operation.",
+    "openquerybi_query_rows": "Rows returned by the SQL queries, by database and operation.",
+    "openquerybi_query_errors_total": "SQL queries that failed, by database and operation.",
+    "openquerybi_engines_created_total": "SQLAlchemy engines created, by database.",
+    "openquerybi_reflection_duration_seconds": "Duration of the schema and sample rows reads, by database and operation.",
+    "openquerybi_dataframe_duration_seconds": "Duration of the DataFrame constructions of query previews.",
+    "openquerybi_serialization_duration_seconds": "Duration of the plot data serializations, by format.",
+    "openquerybi_tool_duration_seconds": "Duration of the MCP and agent tool calls, by tool.",
+    "openquerybi_tool_errors_total": "Tool calls that failed, by tool.",
+    "openquerybi_llm_duration_seconds": "Duration of the LLM calls.",
+    "openquerybi_llm_errors_total": "LLM calls that failed.",
+    "openquerybi_llm_tokens_total": "Tokens used by the LLM calls, by type (uncached input, output, cache_read, cache_creation).",
+    "openquerybi_http_request_duration_seconds": "Duration of the HTTP requests, by route, method and status.",
+    "openquerybi_slow_queries_total": "SQL queries slower than OPENQUERYBI_SLOW_QUERY_SECONDS, by database.",
+}
+
+def _get_metric(name:str, kind:str, labels:dict, buckets:tuple=None):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        metric = _metrics.setdefault(key, {"kind": kind, "value": 0, "sum": 0.0, "count": 0, "buckets": buckets, "counts": [0] * len(buckets or ())})
+    return metric
+
+def increment(name:str, value:float=1, **labels):
+    """Increment a counter.
+    """
+    with _lock:
+        _get_metric(name, "counter", labels)["value"] += value
+
+def observe(name:str, value:float, buckets:tuple=DURATION_BUCKETS, **labels):
+    """Record a value in a histogram.
+    """
+    with _lock:
+        metric = _get_metric(name, "histogram", labels, buckets)
+        metric["sum"] += value
+        metric["count"] += 1
+        index = bisect.bisect_left(metric["buckets"], value)
+        if index < len(metric["counts"]):
+            metric["counts"][index] += 1
+
+@contextmanager
+def span(name:str, **labels):
+    """Time a block of code into the histogram name. Failures are also counted in the counter name
+    with _duration_seconds replaced by _errors_total, when such a counter is documented in HELP.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors = name.replace("_duration_seconds", "_errors_total")
+        if errors in HELP:
+            increment(errors, **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name:str, **labels):
+    """Decorator that times every call of a function with span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_database_label(config:dict):
+    """Get the label of a database in the metrics, its dialect and database name (without host or credentials).
+    """
+    return f"{config.get('dialect', '')}:{config.get('database', '')}"
+
+def record_query(config:dict, operation:str, query:str, seconds:float, rows:int=None, error:Exception=None):
+    """Record the latency and rows of a SQL query, and log it if it is slower than SLOW_QUERY_SECONDS.
+    """
+    database = get_database_label(config)
+    observe("openquerybi_query_duration_seconds", seconds, database=database, operation=operation)
+    if error is not None:
+        increment("openquerybi_query_errors_total", database=database, operation=operation)
+    if rows is not None:
+        observe("openquerybi_query_rows", rows, buckets=ROWS_BUCKETS, database=database, operation=operation)
+    if SLOW_QUERY_SECONDS and seconds >= SLOW_QUERY_SECONDS:
+        increment("openquerybi_slow_queries_total", database=database)
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "database": database, "operation": operation,
+            "seconds": round(seconds, 3), "rows": rows, "error": str(error) if error is not None else None,
+            "query": " ".join(query.split())
+        }
+        if SLOW_QUERY_LOG:
+            with _lock, open(SLOW_QUERY_LOG, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        else:
+            print(f"Slow query: {json.dumps(entry)}")
+
+@contextmanager
+def query_span(config:dict, operation:str, query:str):
+    """Time a SQL query with record_query. The block can set the number of rows returned in the yielded dict.
+    """
+    result = {"rows": None}
+    start = time.perf_counter()
+    try:
+        yield result
+    except Exception as e:
+        record_query(config, operation, query, time.perf_counter() - start, error=e)
+        raise
+    record_query(config, operation, query, time.perf_counter() - start, rows=result["rows"])
+
+def register_cache(name:str, cache):
+    """Expose the stats of a ResultCache as openquerybi_cache_* metrics with the label cache=name.
+    """
+    _caches[name] = cache
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+def render():
+    """Render all the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        metrics = sorted(_metrics.items(), key=lambda item: item[0])
+        metrics = [(key, dict(metric, counts=list(metric["counts"]))) for key, metric in metrics]
+    declared = set()
+    for (name, labels), metric in metrics:
+        if name not in declared:
+            declared.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+        if metric["kind"] == "counter":
+            lines.append(f"{name}{_format_labels(labels)} {metric['value']}")
+            continue
+        cumulative = 0
+        for bound, count in zip(metric["buckets"], metric["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {metric['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {metric['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {metric['count']}")
+    stats = {name: cache.stats() for name, cache in _caches.items()}
+    for stat, kind in (("hits", "counter"), ("misses", "counter"), ("coalesced", "counter"), ("evictions", "counter"), ("entries", "gauge"), ("bytes", "gauge")):
+        name = f"openquerybi_cache_{stat}_total" if kind == "counter" else f"openquerybi_cache_{stat}"
+        lines.append(f"# TYPE {name} {kind}")
+        for cache, values in stats.items():
+            lines.append(f'{name}{{cache="{cache}"}} {values.get(stat, 0)}')
+    return "\n".join(lines) + "\n"
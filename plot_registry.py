@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+import time
+from common import SQLiteStore
+
+workspace_path = os.path.dirname(os.path.abspath(__file__))
+registry_path = os.getenv("OPENQUERYBI_PLOT_REGISTRY", os.path.join(workspace_path, "plots.db"))
+legacy_path = os.path.join(workspace_path, "plot_info.json")
+
+class PlotRegistry(SQLiteStore):
+    """SQLite store of the plots created by plot_from_sql, indexed by plot_id.
+    Plots never change once created, so every plot read is cached in memory.
+    """
+    def __init__(self, path:str, legacy_path:str=None):
+        super().__init__(path)
+        self.cache = {}
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS plots (plot_id TEXT PRIMARY KEY, info TEXT NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_path is not None:
+            self.migrate(legacy_path)
+
+    def migrate(self, json_path:str):
+        """Import the plots of a plot_info.json file. This runs only once per registry.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is None:
+                if os.path.exists(json_path):
+                    with open(json_path, "r") as f:
+                        plots = json.load(f)
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO plots (plot_id, info, created_at) VALUES (?, ?, ?)",
+                        [(plot_id, json.dumps(info), time.time()) for plot_id, info in plots.items()]
+                    )
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+
+    def get(self, plot_id:str):
+        """Get the info of a plot. This will return None if the plot does not exist.
+        """
+        info = self.cache.get(plot_id)
+        if info is None:
+            row = self.connect().execute("SELECT info FROM plots WHERE plot_id = ?", (plot_id,)).fetchone()
+            if row is None:
+                return None
+            info = self.cache.setdefault(plot_id, json.loads(row[0]))
+        return dict(info)
+
+    def add(self, plot_id:str, plot_info:dict):
+        """Store a new plot. This will return False if a plot with the same id already exists.
+        """
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO plots (plot_id, info, created_at) VALUES (?, ?, ?)",
+                (plot_id, json.dumps(plot_info), time.time())
+            )
+        return cursor.rowcount == 1
+
+    def list_plots(self, after:int=0):
+        """List the plots stored after a given row id, in creation order.
+        This will return a list of (rowid, plot_id, plot_info) tuples.
+        """
+        rows = self.connect().execute("SELECT rowid, plot_id, info FROM plots WHERE rowid > ? ORDER BY rowid", (after,)).fetchall()
+        return [(rowid, plot_id, json.loads(info)) for rowid, plot_id, info in rows]
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """Get the plot registry of the process, creating it and migrating plot_info.json on first use.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = PlotRegistry(registry_path, legacy_path)
+    return _registry
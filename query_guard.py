@@ -0,0 +1,116 @@
+import json
+import os
+import sqlglot
+from sqlglot import exp
+import utils
+
+SQLGLOT_DIALECTS = {"postgresql": "postgres", "sqlite": "sqlite", "mysql": "mysql", "mssql": "tsql", "oracle": "oracle"}
+# Default cost limits: estimated rows scanned for SQLite, planner cost units for Postgres
+MAX_QUERY_COST = {
+    "sqlite": float(os.getenv("OPENQUERYBI_MAX_SQLITE_COST", "100000000")),
+    "postgresql": float(os.getenv("OPENQUERYBI_MAX_POSTGRES_COST", "10000000"))
+}
+FORBIDDEN_EXPRESSIONS = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Alter,
+    exp.Command, exp.Into, exp.Lock, exp.Pragma, exp.TruncateTable
+)
+
+class QueryRejected(ValueError):
+    pass
+
+def check_read_only(query:str, dialect:str):
+    """Parse a query and make sure it is a single read-only SELECT (including WITH, UNION, INTERSECT and EXCEPT).
+    This will raise QueryRejected otherwise.
+    """
+    try:
+        statements = [statement for statement in sqlglot.parse(query, read=SQLGLOT_DIALECTS.get(dialect)) if statement is not None]
+    except sqlglot.errors.ParseError as e:
+        raise QueryRejected(f"Could not parse the query: {e}")
+    if len(statements) != 1:
+        raise QueryRejected("Only a single SQL statement can be executed.")
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        raise QueryRejected(f"Only SELECT queries can be executed, got {statement.key.upper()}.")
+    forbidden = statement.find(*FORBIDDEN_EXPRESSIONS)
+    if forbidden is not None:
+        raise QueryRejected(f"Only read-only queries can be executed, found {forbidden.key.upper()}.")
+    return statement
+
+def estimate_sqlite_cost(database:utils.Database, query:str, aliases:dict):
+    """Estimate the cost of a SQLite query as the number of rows it scans, from the tree of its EXPLAIN QUERY PLAN.
+    The tables of a nested loop join (the SCAN and SEARCH rows of one plan node) multiply, a full SCAN counting the
+    size of its table and an index SEARCH counting 1. Subqueries and compound SELECTs add up, correlated subqueries
+    count once per row of the loop they are in. A CTE or subquery (MATERIALIZE or CO-ROUTINE node) counts, when scanned,
+    the cost of the plan that builds it. aliases maps the table aliases used in the query to table names.
+    """
+    plan, _ = database.query(f"EXPLAIN QUERY PLAN {query}")
+    children, subqueries = {}, {}
+    for node, parent, _, detail in plan:
+        detail = [word for word in str(detail).split() if word != "TABLE"]
+        children.setdefault(parent, []).append((node, detail))
+        if len(detail) > 1 and detail[0] in ("MATERIALIZE", "CO-ROUTINE"):
+            subqueries[detail[1]] = node
+    sizes, building = {}, set()
+    def get_size(name:str):
+        name = name if name in subqueries else aliases.get(name, name)
+        if name in subqueries:
+            node = subqueries[name]
+            if node in building:
+                return 1
+            building.add(node)
+            try:
+                return max(get_cost(node), 1)
+            finally:
+                building.discard(node)
+        if name not in sizes:
+            try:
+                rows, _ = database.query(f'SELECT MAX(rowid) FROM "{name}"')
+                sizes[name] = max(int(rows[0][0] or 0), 1)
+            except Exception:
+                sizes[name] = 1
+        return sizes[name]
+    def get_cost(parent):
+        loops, total, has_loops = 1, 0, False
+        for node, detail in children.get(parent, []):
+            if detail and detail[0] in ("SCAN", "SEARCH"):
+                has_loops = True
+                if detail[0] == "SCAN" and len(detail) > 1 and detail[1:3] != ["CONSTANT", "ROW"] and not detail[1].startswith("("):
+                    loops *= get_size(detail[1])
+            if node in children:
+                cost = get_cost(node)
+                total += loops * cost if detail and detail[0] == "CORRELATED" else cost
+        return total + (loops if has_loops else 0)
+    return max(get_cost(0), 1)
+
+def estimate_postgres_cost(database:utils.Database, query:str):
+    """Get the total cost of a Postgres query from its EXPLAIN plan.
+    """
+    plan, _ = database.query(f"EXPLAIN (FORMAT JSON) {query}")
+    plan = plan[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return float(plan[0]["Plan"]["Total Cost"])
+
+def check_query(query:str, database_info:dict):
+    """Check a query before executing it: it must be a read-only SELECT and its estimated cost must not exceed
+    the database's max_query_cost (or the dialect default). This will raise QueryRejected otherwise.
+    """
+    dialect = database_info["dialect"]
+    statement = check_read_only(query, dialect)
+    max_cost = database_info.get("max_query_cost") or MAX_QUERY_COST.get(dialect)
+    if not max_cost:
+        return None
+    database = utils.get_database_class(database_info)
+    query = query.strip().rstrip(";")
+    if dialect == "sqlite":
+        cost = estimate_sqlite_cost(database, query, {table.alias_or_name: table.name for table in statement.find_all(exp.Table)})
+    elif dialect == "postgresql":
+        cost = estimate_postgres_cost(database, query)
+    else:
+        return None
+    if cost > float(max_cost):
+        raise QueryRejected(
+            f"The query is too expensive to run (estimated cost {cost:.0f}, limit {float(max_cost):.0f}). "
+            "Add filters, join conditions or aggregations to reduce the amount of data scanned."
+        )
+    return cost
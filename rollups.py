@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import time
+import sqlglot
+from sqlglot import exp
+import utils
+import plot_registry
+import query_guard
+from common import SQLiteStore, BackgroundTask
+from cache import json_default
+
+workspace_path = os.path.dirname(os.path.abspath(__file__))
+ROLLUPS_ENABLED = os.getenv("OPENQUERYBI_ROLLUPS", "0") == "1"
+rollup_store_path = os.getenv("OPENQUERYBI_ROLLUP_STORE", os.path.join(workspace_path, "rollups.db"))
+# Plots refreshed at least this many times per hour (update_interval of 30 seconds or less) are materialized
+ROLLUP_MIN_REFRESHES_PER_HOUR = float(os.getenv("OPENQUERYBI_ROLLUP_MIN_REFRESHES_PER_HOUR", "120"))
+ROLLUP_REFRESH_INTERVAL = float(os.getenv("OPENQUERYBI_ROLLUP_REFRESH_INTERVAL", "300"))
+ROLLUP_IDLE_TIMEOUT = float(os.getenv("OPENQUERYBI_ROLLUP_IDLE_TIMEOUT", "3600"))
+ROLLUP_DIALECTS = ("sqlite", "postgresql")
+
+def is_aggregate(query:str, dialect:str):
+    """Check if a query aggregates rows, with GROUP BY, DISTINCT or an aggregate function.
+    """
+    try:
+        statement = sqlglot.parse_one(query, read=query_guard.SQLGLOT_DIALECTS.get(dialect))
+    except sqlglot.errors.ParseError:
+        return False
+    return statement.find(exp.AggFunc, exp.Group, exp.Distinct) is not None
+
+def is_rollup_candidate(plot_info:dict):
+    """Check if a plot should be materialized: an aggregate query on SQLite or Postgres that is refreshed
+    at least ROLLUP_MIN_REFRESHES_PER_HOUR times per hour.
+    """
+    config = plot_info["database_configs"]
+    return (
+        plot_info.get("rollup", True)
+        and config.get("dialect") in ROLLUP_DIALECTS
+        and 3600 / max(plot_info["update_interval"], 1) >= ROLLUP_MIN_REFRESHES_PER_HOUR
+        and is_aggregate(plot_info["query"], config["dialect"])
+    )
+
+class RollupStore(SQLiteStore, BackgroundTask):
+    """Local SQLite store of the results of hot aggregate plots, keyed by plot fingerprint.
+    Candidate plots are found in the plot registry. Each one that was read in the last idle_timeout seconds is
+    re-queried every refresh_interval seconds in the background, one at a time, and its reads are served from the store,
+    so the source database runs the aggregate once per refresh_interval instead of once per update_interval.
+    The store file can be shared by several processes; leases (a shared_cache backend) then make sure that each rollup
+    is refreshed by one of them.
+    """
+    def __init__(self, path:str, load, refresh_interval:float=300, idle_timeout:float=3600, tick:float=5.0, leases=None, owner:str=None):
+        super().__init__(path)
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.leases = leases
+        self.owner = owner
+        self.candidates = {}
+        self.last_read = {}
+        self.last_rowid = 0
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS rollups (fingerprint TEXT PRIMARY KEY, data TEXT NOT NULL, refreshed_at REAL NOT NULL)")
+
+    def rescan(self):
+        for rowid, plot_id, plot_info in plot_registry.get_registry().list_plots(after=self.last_rowid):
+            if is_rollup_candidate(plot_info):
+                self.candidates.setdefault(utils.get_plot_fingerprint(plot_info), plot_info)
+            self.last_rowid = rowid
+
+    def touch(self, key:str):
+        """Record a read of a plot by a client, so that its rollup is kept refreshed. Reads of plots that are not
+        candidates are ignored.
+        """
+        if key in self.candidates:
+            self.last_read[key] = time.monotonic()
+
+    def get(self, key:str):
+        """Get the materialized data of a plot. This will return None if the plot is not materialized,
+        or if its data was not refreshed in the last 2 refresh intervals. This does not count as a read, see touch.
+        """
+        if key not in self.candidates:
+            return None
+        row = self.connect().execute("SELECT data, refreshed_at FROM rollups WHERE fingerprint = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > 2 * self.refresh_interval:
+            return None
+        return json.loads(row[0])
+
+    def refresh(self, key:str, plot_info:dict):
+        data = self.load(key, plot_info)
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rollups (fingerprint, data, refreshed_at) VALUES (?, ?, ?)",
+                (key, json.dumps(data, default=json_default), time.time())
+            )
+        return data
+
+    def refresh_due(self):
+        """Refresh the materialized plots that were read recently and are older than refresh_interval.
+        """
+        self.rescan()
+        refreshed = dict(self.connect().execute("SELECT fingerprint, refreshed_at FROM rollups").fetchall())
+        for key, plot_info in list(self.candidates.items()):
+            last_read = self.last_read.get(key)
+            if last_read is None or time.monotonic() - last_read > self.idle_timeout:
+                continue
+            if time.time() - refreshed.get(key, 0) < self.refresh_interval:
+                continue
+            if self.leases is not None and not self.leases.acquire_lease(f"rollup:{key}", self.owner, self.refresh_interval):
+                continue
+            try:
+                self.refresh(key, plot_info)
+            except Exception as e:
+                print(f"Could not refresh the rollup of plot {key}: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh_due)
+            except Exception as e:
+                print(f"Could not refresh the rollups: {e}")
+            await asyncio.sleep(self.tick)
@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import random
+import time
+import utils
+import plot_registry
+from cache import ResultCache
+from common import BackgroundTask
+
+class PlotScheduler(BackgroundTask):
+    """Refresh the data of live plots in the background, so that plot requests are served from the cache.
+    Each plot is refreshed every update_interval seconds (plus a random jitter), with at most
+    max_concurrency_per_database refreshes running at a time against the same database.
+    Plots that were not read for idle_timeout seconds are paused until they are read again.
+    Jobs are keyed by plot fingerprint (see utils.get_plot_fingerprint), so equivalent plots share one refresh,
+    run at the shortest update_interval among them.
+    When several processes share the cache, leases (a shared_cache backend) make sure each plot is refreshed by one
+    process at a time; the other processes read its fresh data from the shared cache instead of querying the database.
+    A lease is released when its plot is paused and when the scheduler stops, so another process can take over.
+    """
+    def __init__(self, cache:ResultCache, load, idle_timeout:float=300, max_concurrency_per_database:int=2,
+                 jitter:float=0.1, rescan_interval:float=30, tick:float=1.0, leases=None, owner:str=None):
+        self.cache = cache
+        self.load = load
+        self.idle_timeout = idle_timeout
+        self.max_concurrency_per_database = max_concurrency_per_database
+        self.jitter = jitter
+        self.rescan_interval = rescan_interval
+        self.tick = tick
+        self.leases = leases
+        self.owner = owner
+        self.jobs = {}
+        self.semaphores = {}
+        self.refreshes = set()
+        self.subscribers = {}
+        self.last_rowid = 0
+
+    def add(self, key:str, plot_info:dict, paused:bool=False):
+        """Schedule a plot. Its first refresh happens at a random time within its update_interval.
+        A plot added paused is only refreshed once it is read or subscribed to.
+        """
+        job = self.jobs.get(key)
+        if job is not None:
+            if plot_info["update_interval"] < job["plot_info"]["update_interval"]:
+                job["plot_info"] = plot_info
+                job["next_run"] = min(job["next_run"], time.monotonic() + plot_info["update_interval"])
+        else:
+            now = time.monotonic()
+            self.jobs[key] = {
+                "plot_info": plot_info,
+                "next_run": now + random.uniform(0, plot_info["update_interval"]),
+                "last_read": float("-inf") if paused else now,
+                "last_refresh": None,
+                "digest": None,
+                "refreshing": False,
+                "leased": False
+            }
+
+    def touch(self, key:str, plot_info:dict):
+        """Record a read of a plot, scheduling it or resuming it if needed.
+        This will return True if the plot is being refreshed in the background and its cached data can be served as is.
+        """
+        if not self.running:
+            return False
+        job = self.jobs.get(key)
+        if job is None:
+            self.add(key, plot_info)
+            return False
+        now = time.monotonic()
+        active = (
+            not self.is_paused(key, job)
+            and job["last_refresh"] is not None
+            and now - job["last_refresh"] < 2 * job["plot_info"]["update_interval"] + self.tick
+        )
+        job["last_read"] = now
+        return active
+
+    def is_paused(self, key:str, job:dict):
+        return not self.subscribers.get(key) and time.monotonic() - job["last_read"] > self.idle_timeout
+
+    def subscribe(self, key:str, plot_info:dict):
+        """Subscribe to the updates of a plot. This will return a queue that receives the plot data each time it changes.
+        Subscribed plots are never paused, and all the subscribers of a plot share the same refresh.
+        """
+        self.add(key, plot_info)
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.setdefault(key, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, key:str, queue:asyncio.Queue):
+        subscribers = self.subscribers.get(key, set())
+        subscribers.discard(queue)
+        if not subscribers:
+            self.subscribers.pop(key, None)
+        if key in self.jobs:
+            self.jobs[key]["last_read"] = time.monotonic()
+
+    def publish(self, key:str, data:dict):
+        """Send the new data of a plot to its subscribers. Slow subscribers only get the latest data.
+        """
+        for queue in self.subscribers.get(key, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(data)
+
+    async def stop(self):
+        await super().stop()
+        refreshes = list(self.refreshes)
+        for refresh in refreshes:
+            refresh.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+        for key, job in list(self.jobs.items()):
+            await self.release(key, job)
+
+    async def release(self, key:str, job:dict):
+        """Release the refresh lease of a plot, if this process holds it, so that another process can take over its refreshes.
+        """
+        if self.leases is not None and job["leased"]:
+            job["leased"] = False
+            try:
+                await asyncio.to_thread(self.leases.release_lease, f"refresh:{key}", self.owner)
+            except Exception as e:
+                print(f"Could not release the refresh lease of plot {key}: {e}")
+
+    def rescan(self):
+        for rowid, plot_id, plot_info in plot_registry.get_registry().list_plots(after=self.last_rowid):
+            self.add(utils.get_plot_fingerprint(plot_info), plot_info, paused=True)
+            self.last_rowid = rowid
+
+    async def run(self):
+        last_rescan = None
+        while True:
+            now = time.monotonic()
+            if last_rescan is None or now - last_rescan > self.rescan_interval:
+                try:
+                    await asyncio.to_thread(self.rescan)
+                except Exception as e:
+                    print(f"Could not load the registered plots: {e}")
+                last_rescan = now
+            for key, job in list(self.jobs.items()):
+                if job["refreshing"]:
+                    continue
+                if self.is_paused(key, job):
+                    await self.release(key, job)
+                elif job["next_run"] <= now:
+                    job["refreshing"] = True
+                    refresh = asyncio.create_task(self.refresh(key, job))
+                    self.refreshes.add(refresh)
+                    refresh.add_done_callback(self.refreshes.discard)
+            await asyncio.sleep(self.tick)
+
+    async def refresh(self, key:str, job:dict):
+        plot_info = job["plot_info"]
+        interval = plot_info["update_interval"]
+        engine_key = utils.get_engine_key(plot_info["database_configs"])
+        semaphore = self.semaphores.setdefault(engine_key, asyncio.Semaphore(self.max_concurrency_per_database))
+        try:
+            leased = self.leases is None or await asyncio.to_thread(self.leases.acquire_lease, f"refresh:{key}", self.owner, 3 * interval + self.tick)
+            job["leased"] = self.leases is not None and leased
+            if not leased:
+                # Another process refreshes this plot, only its fresh data counts as a refresh
+                data = await asyncio.to_thread(self.cache.sync, key, False)
+                if data is None:
+                    return
+            else:
+                async with semaphore:
+                    data = await asyncio.to_thread(self.cache.get_or_compute, key, interval, lambda: self.load(key, plot_info), True)
+            job["last_refresh"] = time.monotonic()
+            digest = hashlib.sha256(self.cache.get_encoded(key, data)).hexdigest()
+            if digest != job["digest"]:
+                job["digest"] = digest
+                self.publish(key, data)
+        except Exception as e:
+            print(f"Could not refresh plot {key}: {e}")
+        finally:
+            job["next_run"] = time.monotonic() + interval * (1 + random.uniform(0, self.jitter))
+            job["refreshing"] = False
@@ -0,0 +1,94 @@
+import hashlib
+import math
+import re
+import threading
+from collections import Counter
+
+TABLE_NAME_WEIGHT = 3
+
+def tokenize(text:str):
+    """Split a text into lowercase words, also splitting snake_case and camelCase identifiers.
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+class SchemaIndex():
+    """Local BM25 index over the tables of the configured databases.
+    Each table is indexed by its name, its CREATE TABLE statement and its sample rows.
+    Updates are incremental: only tables whose DDL or sample rows changed are re-indexed.
+    """
+    def __init__(self, k1:float=1.5, b:float=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = {}
+        self.document_frequency = Counter()
+        self.total_length = 0
+        self.lock = threading.Lock()
+
+    def update(self, database_name:str, tables:list):
+        """Index the tables of a database, as stored in its catalog (a list of dicts with name, ddl and sample).
+        This will return the number of tables that were (re-)indexed.
+        """
+        changed = 0
+        with self.lock:
+            current = set()
+            for table in tables:
+                key = (database_name, table["name"])
+                current.add(key)
+                digest = hashlib.sha256((table["ddl"] + table["sample"]).encode()).hexdigest()
+                document = self.documents.get(key)
+                if document is not None and document["digest"] == digest:
+                    continue
+                self._remove(key)
+                terms = Counter(tokenize(table["name"]) * TABLE_NAME_WEIGHT + tokenize(table["ddl"]) + tokenize(table["sample"]))
+                self.documents[key] = {"digest": digest, "terms": terms, "length": sum(terms.values()), "table": table}
+                self.document_frequency.update(terms.keys())
+                self.total_length += self.documents[key]["length"]
+                changed += 1
+            for key in [key for key in self.documents if key[0] == database_name and key not in current]:
+                self._remove(key)
+        return changed
+
+    def database_names(self):
+        with self.lock:
+            return {key[0] for key in self.documents}
+
+    def remove_database(self, database_name:str):
+        with self.lock:
+            for key in [key for key in self.documents if key[0] == database_name]:
+                self._remove(key)
+
+    def search(self, question:str, top_k:int=5, database_name:str=None):
+        """Rank the indexed tables by relevance to a question.
+        This will return a list of (score, database_name, table) tuples, best first, without tables that match no word.
+        """
+        terms = set(tokenize(question))
+        with self.lock:
+            count = len(self.documents)
+            if count == 0 or not terms:
+                return []
+            average_length = self.total_length / count
+            idf = {
+                term: math.log(1 + (count - self.document_frequency[term] + 0.5) / (self.document_frequency[term] + 0.5))
+                for term in terms if self.document_frequency[term]
+            }
+            results = []
+            for (database, name), document in self.documents.items():
+                if database_name and database != database_name:
+                    continue
+                score = 0.0
+                for term, weight in idf.items():
+                    frequency = document["terms"].get(term, 0)
+                    if frequency:
+                        norm = self.k1 * (1 - self.b + self.b * document["length"] / average_length)
+                        score += weight * frequency * (self.k1 + 1) / (frequency + norm)
+                if score > 0:
+                    results.append((score, database, document["table"]))
+        results.sort(key=lambda result: result[0], reverse=True)
+        return results[:top_k]
+
+    def _remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is not None:
+            self.document_frequency.subtract(document["terms"].keys())
+            self.total_length -= document["length"]
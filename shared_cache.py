@@ -0,0 +1,215 @@
+import json
+import os
+import socket
+import time
+import uuid
+from cache import ResultCache, encode_json
+from common import SQLiteStore
+
+# Expired entries are kept this many seconds, so that they can still be served stale or used for incremental refreshes
+SHARED_CACHE_RETENTION = float(os.getenv("OPENQUERYBI_SHARED_CACHE_RETENTION", "86400"))
+
+def get_owner():
+    """Get a name for this process, unique across hosts and restarts, used as lease owner.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class SQLiteBackend(SQLiteStore):
+    """Shared cache and leases in a local SQLite file, for workers running on the same host.
+    """
+    isolation_level = None
+
+    def __init__(self, path:str, retention:float=SHARED_CACHE_RETENTION):
+        super().__init__(path)
+        self.retention = retention
+        self.writes = 0
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def get(self, key:str):
+        """Get an entry. This will return a (value, expires_at) tuple, expired or not, or None if the key is missing.
+        """
+        row = self.connect().execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def set(self, key:str, value, ttl:float, encoded:bytes=None):
+        """Store an entry. encoded is the JSON encoding of value, if it is already known.
+        """
+        now = time.time()
+        conn = self.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, (encoded or encode_json(value)).decode(), now + ttl)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            conn.execute("DELETE FROM entries WHERE expires_at < ?", (now - self.retention,))
+
+    def delete(self, key:str):
+        self.connect().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def acquire_lease(self, name:str, owner:str, ttl:float):
+        """Acquire or renew a lease for ttl seconds. This will return False if another owner holds it.
+        """
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            return True
+        finally:
+            conn.execute("COMMIT")
+
+    def release_lease(self, name:str, owner:str):
+        self.connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+class RedisBackend():
+    """Shared cache and leases in Redis, for workers running on several hosts.
+    client can be any object with the get, set (with nx, xx, ex and px) and delete methods of redis-py,
+    such as fakeredis as a local stand-in.
+    """
+    def __init__(self, client, prefix:str="openquerybi:", retention:float=SHARED_CACHE_RETENTION):
+        self.client = client
+        self.prefix = prefix
+        self.retention = retention
+
+    @classmethod
+    def from_url(cls, url:str):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("A Redis shared cache requires the redis package to be installed.")
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key:str):
+        raw = self.client.get(f"{self.prefix}cache:{key}")
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry["value"], entry["expires_at"]
+
+    def set(self, key:str, value, ttl:float, encoded:bytes=None):
+        """Store an entry. encoded is the JSON encoding of value, if it is already known.
+        """
+        entry = b'{"value":' + (encoded or encode_json(value)) + b',"expires_at":' + repr(time.time() + ttl).encode() + b"}"
+        self.client.set(f"{self.prefix}cache:{key}", entry, ex=int(ttl + self.retention))
+
+    def delete(self, key:str):
+        self.client.delete(f"{self.prefix}cache:{key}")
+
+    def acquire_lease(self, name:str, owner:str, ttl:float):
+        """Acquire or renew a lease for ttl seconds. This will return False if another owner holds it.
+        """
+        key = f"{self.prefix}lease:{name}"
+        if self.client.set(key, owner, nx=True, px=int(ttl * 1000)):
+            return True
+        current = self.client.get(key)
+        if isinstance(current, bytes):
+            current = current.decode()
+        return current == owner and bool(self.client.set(key, owner, xx=True, px=int(ttl * 1000)))
+
+    def release_lease(self, name:str, owner:str):
+        key = f"{self.prefix}lease:{name}"
+        current = self.client.get(key)
+        if isinstance(current, bytes):
+            current = current.decode()
+        if current == owner:
+            self.client.delete(key)
+
+def get_backend(url:str):
+    """Get the shared cache backend of a URL: sqlite:///path/to/file.db or redis://host:port/db.
+    This will return None if url is empty, meaning that the cache is not shared.
+    """
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.split("://")[0] in ("redis", "rediss", "unix"):
+        return RedisBackend.from_url(url)
+    raise ValueError(f"Unsupported shared cache URL: {url}")
+
+class SharedResultCache(ResultCache):
+    """ResultCache backed by a cache shared by several processes.
+    Computed values are kept in memory and in the shared backend (set only stores in memory). A value missing or expired
+    in memory is read from the backend, and only computed if it is missing or expired there too. Computations are guarded
+    by a lease, so that when several processes miss the same key at once, one computes it and the others wait for its
+    result in the backend.
+    """
+    def __init__(self, backend, owner:str=None, lease_ttl:float=60, poll_interval:float=0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.backend = backend
+        self.owner = owner or get_owner()
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+
+    def _expire(self, key, ttl:float):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["expires_at"] = time.monotonic() + ttl
+
+    def sync(self, key, allow_stale:bool=True):
+        """Copy a value from the backend into memory, with the time to live it has left there.
+        This will return the value, or None if it is missing (or expired, unless allow_stale is True).
+        """
+        entry = self.backend.get(key)
+        if entry is None or (not allow_stale and entry[1] <= time.time()):
+            return None
+        value, expires_at = entry
+        self.set(key, value, max(expires_at - time.time(), 0))
+        return value
+
+    def get(self, key, allow_stale:bool=False):
+        value = super().get(key, allow_stale)
+        if value is None:
+            value = self.sync(key, allow_stale)
+        return value
+
+    def peek(self, key):
+        value = super().peek(key)
+        if value is None:
+            entry = self.backend.get(key)
+            value = None if entry is None else entry[0]
+        return value
+
+    def get_or_compute(self, key, ttl:float, compute, force:bool=False):
+        remaining = {}
+        def load():
+            if not force:
+                entry = self.backend.get(key)
+                if entry is not None and entry[1] > time.time():
+                    remaining["ttl"] = entry[1] - time.time()
+                    return entry[0]
+            lease = f"compute:{key}"
+            leased = self.backend.acquire_lease(lease, self.owner, self.lease_ttl)
+            if not force:
+                deadline = time.monotonic() + self.lease_ttl
+                while not leased and time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    entry = self.backend.get(key)
+                    if entry is not None and entry[1] > time.time():
+                        remaining["ttl"] = entry[1] - time.time()
+                        return entry[0]
+                    leased = self.backend.acquire_lease(lease, self.owner, self.lease_ttl)
+            try:
+                value = compute()
+                # Cached here first, so that the value is encoded once for this cache and the backend
+                self.set(key, value, ttl)
+                self.backend.set(key, value, ttl, self.get_encoded(key, value))
+                return value
+            finally:
+                if leased:
+                    self.backend.release_lease(lease, self.owner)
+        value = ResultCache.get_or_compute(self, key, ttl, load, force)
+        if "ttl" in remaining:
+            self._expire(key, remaining["ttl"])
+        return value
+
+    def invalidate(self, key=None):
+        super().invalidate(key)
+        if key is not None:
+            self.backend.delete(key)
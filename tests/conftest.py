@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The scheduler rescans the plot registry, keep the tests away from the real one
+os.environ.setdefault("OPENQUERYBI_PLOT_REGISTRY", os.path.join(tempfile.mkdtemp(prefix="openquerybi-tests-"), "plots.db"))
@@ -0,0 +1,49 @@
+import datetime
+import json
+from decimal import Decimal
+from fastapi.encoders import jsonable_encoder
+from cache import ResultCache, json_default
+
+def test_json_default_matches_fastapi():
+    data = {
+        "x": [datetime.datetime(2024, 1, 1, 10), datetime.date(2024, 1, 2)],
+        "y": [Decimal("12.50"), Decimal("3")]
+    }
+    assert json.loads(json.dumps(data, default=json_default)) == jsonable_encoder(data)
+
+def count_encodings(monkeypatch):
+    import cache
+    calls = []
+    encode_json = cache.encode_json
+    def counted(value):
+        calls.append(value)
+        return encode_json(value)
+    monkeypatch.setattr(cache, "encode_json", counted)
+    return calls
+
+def test_values_are_encoded_once(monkeypatch):
+    calls = count_encodings(monkeypatch)
+    cache = ResultCache()
+    data = {"x": [1, 2], "y": [Decimal("1.5"), 2]}
+    value = cache.get_or_compute("plot", 60, lambda: data)
+    assert cache.get_encoded("plot", value) == b'{"x":[1,2],"y":[1.5,2]}'
+    cache.set("plot", value, 60)
+    assert cache.get_encoded("plot", value) is cache.get_encoded("plot", value)
+    assert len(calls) == 1
+    assert cache.stats()["bytes"] == len(b'{"x":[1,2],"y":[1.5,2]}')
+
+def test_shared_values_are_encoded_once(monkeypatch, tmp_path):
+    import shared_cache
+    calls = count_encodings(monkeypatch)
+    cache = shared_cache.SharedResultCache(shared_cache.SQLiteBackend(str(tmp_path / "shared_cache.db")))
+    value = cache.get_or_compute("plot", 60, lambda: {"x": [1], "y": [2]})
+    cache.get_encoded("plot", value)
+    assert len(calls) == 1
+    assert cache.backend.get("plot")[0] == {"x": [1], "y": [2]}
+
+def test_encodings_count_toward_max_bytes():
+    cache = ResultCache(max_bytes=20)
+    cache.set("a", {"x": [1, 2, 3]}, 60)
+    cache.set("b", {"x": [4, 5, 6]}, 60)
+    assert cache.peek("a") is None
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,81 @@
+import sqlite3
+import pytest
+import incremental
+import utils
+
+QUERY = "SELECT DATE(invoice_date) AS date, SUM(total) AS total FROM invoices GROUP BY DATE(invoice_date) ORDER BY date"
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "invoices.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE invoices (id INTEGER PRIMARY KEY, invoice_date TEXT, total REAL)")
+        conn.execute("CREATE INDEX invoices_date ON invoices (invoice_date)")
+        conn.executemany(
+            "INSERT INTO invoices (invoice_date, total) VALUES (?, ?)",
+            [(f"2024-01-{day:02d} {hour:02d}:00:00", day + hour) for day in range(1, 11) for hour in (9, 15)]
+        )
+    yield path
+    utils.dispose_engine({"dialect": "sqlite", "database": path})
+
+def get_plot_info(path:str):
+    return {
+        "type": "line", "x": "date", "y": "total", "query": QUERY, "limit": 1000,
+        "database_configs": {"dialect": "sqlite", "database": path}
+    }
+
+def query_all(path:str):
+    x, y = utils.get_database_class({"dialect": "sqlite", "database": path}).query_columns(QUERY, ["date", "total"])
+    return {"x": x, "y": y}
+
+@pytest.mark.parametrize("query, x, expected", [
+    (QUERY, "date", "WHERE invoice_date >= :watermark GROUP BY"),
+    ("SELECT date_trunc('day', created_at) AS day, COUNT(*) AS n FROM events GROUP BY 1", "day", "WHERE created_at >= :watermark"),
+    ("SELECT CAST(created_at AS DATE) AS day, COUNT(*) AS n FROM events WHERE kind = 'a' GROUP BY day", "day", "WHERE kind = 'a' AND created_at >= :watermark"),
+    ("SELECT created_at AS day, amount FROM events", "day", "WHERE created_at >= :watermark"),
+])
+def test_push_watermark(query, x, expected):
+    assert expected in incremental.push_watermark(query, x, "postgresql" if "date_trunc" in query else "sqlite")
+
+@pytest.mark.parametrize("query", [
+    "SELECT DATE(created_at) AS day, COUNT(*) AS n FROM events GROUP BY kind",
+    "SELECT DATE(created_at) AS day FROM events UNION SELECT DATE(updated_at) FROM events",
+    "SELECT DATE(created_at) AS day, amount FROM events LIMIT 10",
+    "SELECT created_at AS day, SUM(amount) OVER (ORDER BY created_at) AS amount FROM events",
+    "SELECT MAX(created_at) AS day, COUNT(*) AS n FROM events",
+])
+def test_push_watermark_keeps_the_result_exact(query):
+    assert incremental.push_watermark(query, "day", "sqlite") is None
+
+def test_pushed_watermark_uses_the_index(database):
+    query = incremental.push_watermark(QUERY, "date", "sqlite")
+    with sqlite3.connect(database) as conn:
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", {"watermark": "2024-01-09"})]
+    assert any(detail.startswith("SEARCH invoices USING INDEX invoices_date") for detail in plan)
+
+def test_refresh_matches_a_full_query(database):
+    plot_info = get_plot_info(database)
+    previous = query_all(database)
+    with sqlite3.connect(database) as conn:
+        conn.executemany(
+            "INSERT INTO invoices (invoice_date, total) VALUES (?, ?)",
+            [("2024-01-10 20:00:00", 100), ("2024-01-11 09:00:00", 200), ("2024-01-12 09:00:00", 300)]
+        )
+    assert incremental.can_refresh_incrementally(plot_info, previous)
+    assert incremental.refresh(plot_info, previous) == query_all(database)
+
+def test_merge():
+    previous = {"x": ["2024-01-01", "2024-01-02", "2024-01-03"], "y": [1, 2, 3]}
+    data = incremental.merge(previous, ["2024-01-03", "2024-01-04"], [30, 4], "2024-01-03")
+    assert data == {"x": ["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-04"], "y": [1, 2, 30, 4]}
+    assert incremental.merge(previous, ["2024-01-03", "2024-01-04"], [30, 4], "2024-01-03", limit=3)["y"] == [1, 2, 30]
+
+def test_can_refresh_incrementally_requires_dates():
+    plot_info = {"type": "line", "limit": 100}
+    assert not incremental.can_refresh_incrementally(plot_info, {"x": ["Alice", "Bob"], "y": [1, 2]})
+    assert not incremental.can_refresh_incrementally(dict(plot_info, incremental=False), {"x": ["2024-01-01"], "y": [1]})
+
+def test_full_refresh_plots_do_not_share_the_fingerprint(database):
+    plot_info = get_plot_info(database)
+    assert utils.get_plot_fingerprint(plot_info) == utils.get_plot_fingerprint(dict(plot_info, incremental=True))
+    assert utils.get_plot_fingerprint(plot_info) != utils.get_plot_fingerprint(dict(plot_info, incremental=False))
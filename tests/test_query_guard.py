@@ -0,0 +1,52 @@
+import sqlite3
+import pytest
+import query_guard
+import utils
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("query_guard") / "events.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, kind TEXT, amount REAL)")
+        conn.execute("CREATE TABLE kinds (kind TEXT PRIMARY KEY, label TEXT)")
+        conn.executemany("INSERT INTO events (kind, amount) VALUES (?, ?)", [(f"k{i % 10}", i) for i in range(20000)])
+        conn.executemany("INSERT INTO kinds (kind, label) VALUES (?, ?)", [(f"k{i}", f"Kind {i}") for i in range(10)])
+    info = {"dialect": "sqlite", "database": path, "max_query_cost": 100000000}
+    yield info
+    utils.dispose_engine(info)
+
+@pytest.mark.parametrize("query, cost", [
+    ("SELECT * FROM events", 20000),
+    ("SELECT * FROM events UNION ALL SELECT * FROM events", 40000),
+    ("SELECT (SELECT COUNT(*) FROM events), (SELECT SUM(amount) FROM events)", 40001),
+    ("SELECT kind, SUM(amount) FROM events GROUP BY kind", 20000),
+    ("SELECT * FROM events e JOIN kinds k ON k.kind = e.kind", 20000),
+    ("SELECT * FROM events e, kinds k", 200000),
+    ("SELECT kind FROM kinds", 10),
+])
+def test_estimate_sqlite_cost(database, query, cost):
+    assert query_guard.check_query(query, database) == cost
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM events a, events b",
+    "WITH x AS (SELECT * FROM events) SELECT * FROM x, x AS y",
+    "WITH x AS MATERIALIZED (SELECT * FROM events) SELECT * FROM x JOIN events e ON e.amount > x.amount",
+    "SELECT * FROM (SELECT kind, amount FROM events GROUP BY kind, amount) a, events b",
+])
+def test_cross_joins_are_rejected(database, query):
+    with pytest.raises(query_guard.QueryRejected, match="too expensive"):
+        query_guard.check_query(query, database)
+
+@pytest.mark.parametrize("query", [
+    "DELETE FROM events",
+    "SELECT 1; DROP TABLE events",
+    "INSERT INTO kinds SELECT * FROM kinds",
+    "PRAGMA query_only=OFF",
+])
+def test_writes_are_rejected(database, query):
+    with pytest.raises(query_guard.QueryRejected):
+        query_guard.check_query(query, database)
+
+def test_connections_are_read_only(database):
+    with pytest.raises(Exception, match="readonly"):
+        utils.get_database_class(database).query("CREATE TABLE t (a)")
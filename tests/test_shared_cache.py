@@ -0,0 +1,164 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import shared_cache
+from scheduler import PlotScheduler
+
+workspace_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLOT_INFO = {"update_interval": 10, "database_configs": {"dialect": "sqlite", "database": ":memory:"}}
+
+def sqlite_backends(tmp_path):
+    path = str(tmp_path / "shared_cache.db")
+    return shared_cache.SQLiteBackend(path), shared_cache.SQLiteBackend(path)
+
+def redis_backends(tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return shared_cache.RedisBackend(fakeredis.FakeRedis(server=server)), shared_cache.RedisBackend(fakeredis.FakeRedis(server=server))
+
+@pytest.fixture(params=[sqlite_backends, redis_backends], ids=["sqlite", "redis"])
+def backends(request, tmp_path):
+    """Two backend instances sharing one store, standing in for two workers."""
+    return request.param(tmp_path)
+
+def test_lease_is_exclusive(backends):
+    first, second = backends
+    assert first.acquire_lease("refresh:a", "worker-1", 60)
+    assert not second.acquire_lease("refresh:a", "worker-2", 60)
+    assert second.acquire_lease("refresh:b", "worker-2", 60)
+
+def test_lease_is_renewed_by_its_owner(backends):
+    first, second = backends
+    assert first.acquire_lease("refresh:a", "worker-1", 60)
+    assert first.acquire_lease("refresh:a", "worker-1", 60)
+    assert not second.acquire_lease("refresh:a", "worker-2", 60)
+
+def test_lease_expires(backends):
+    first, second = backends
+    assert first.acquire_lease("refresh:a", "worker-1", 0.1)
+    time.sleep(0.2)
+    assert second.acquire_lease("refresh:a", "worker-2", 60)
+    assert not first.acquire_lease("refresh:a", "worker-1", 60)
+
+def test_lease_is_released_only_by_its_owner(backends):
+    first, second = backends
+    assert first.acquire_lease("refresh:a", "worker-1", 60)
+    second.release_lease("refresh:a", "worker-2")
+    assert not second.acquire_lease("refresh:a", "worker-2", 60)
+    first.release_lease("refresh:a", "worker-1")
+    assert second.acquire_lease("refresh:a", "worker-2", 60)
+
+def test_entries_are_shared(backends):
+    first, second = backends
+    first.set("plot", {"x": [1], "y": [2]}, 60)
+    value, expires_at = second.get("plot")
+    assert value == {"x": [1], "y": [2]}
+    assert expires_at > time.time()
+    second.delete("plot")
+    assert first.get("plot") is None
+
+def test_sqlite_lease_across_processes(tmp_path):
+    path = str(tmp_path / "shared_cache.db")
+    backend = shared_cache.SQLiteBackend(path)
+    def run(code):
+        script = f"import shared_cache\nbackend = shared_cache.SQLiteBackend({path!r})\n{code}"
+        return subprocess.run([sys.executable, "-c", script], cwd=workspace_path, capture_output=True, text=True, check=True).stdout.strip()
+    assert run("print(backend.acquire_lease('refresh:a', 'worker-2', 60))") == "True"
+    assert not backend.acquire_lease("refresh:a", "worker-1", 60)
+    run("backend.release_lease('refresh:a', 'worker-2')")
+    assert backend.acquire_lease("refresh:a", "worker-1", 60)
+    assert run("print(backend.acquire_lease('refresh:a', 'worker-2', 60))") == "False"
+
+def test_shared_result_cache_computes_once(backends):
+    first, second = backends
+    caches = [shared_cache.SharedResultCache(first, owner="worker-1"), shared_cache.SharedResultCache(second, owner="worker-2")]
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"x": [1, 2], "y": [3, 4]}
+    results = [None, None]
+    def read(i):
+        results[i] = caches[i].get_or_compute("plot", 60, compute)
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results[0] == results[1] == {"x": [1, 2], "y": [3, 4]}
+
+def test_shared_result_cache_keeps_the_remaining_ttl(backends):
+    first, second = backends
+    writer = shared_cache.SharedResultCache(first, owner="worker-1")
+    reader = shared_cache.SharedResultCache(second, owner="worker-2")
+    writer.get_or_compute("plot", 0.2, lambda: {"x": [1], "y": [1]})
+    assert reader.get_or_compute("plot", 60, lambda: {"x": [2], "y": [2]}) == {"x": [1], "y": [1]}
+    time.sleep(0.3)
+    assert reader.get("plot") is None
+    assert reader.sync("plot", allow_stale=False) is None
+    assert reader.get("plot", allow_stale=True) == {"x": [1], "y": [1]}
+    assert reader.get_or_compute("plot", 60, lambda: {"x": [2], "y": [2]}) == {"x": [2], "y": [2]}
+
+def test_shared_result_cache_invalidate(backends):
+    first, second = backends
+    writer = shared_cache.SharedResultCache(first, owner="worker-1")
+    reader = shared_cache.SharedResultCache(second, owner="worker-2")
+    writer.get_or_compute("plot", 60, lambda: {"x": [1], "y": [1]})
+    writer.invalidate("plot")
+    assert reader.get("plot") is None
+    assert first.get("plot") is None
+
+def test_scheduler_releases_the_refresh_lease_on_stop(tmp_path):
+    first, second = sqlite_backends(tmp_path)
+    async def run():
+        scheduler = PlotScheduler(
+            shared_cache.SharedResultCache(first, owner="worker-1"), lambda key, plot_info: {"x": [1], "y": [1]},
+            leases=first, owner="worker-1"
+        )
+        scheduler.start()
+        scheduler.add("plot", PLOT_INFO)
+        await scheduler.refresh("plot", scheduler.jobs["plot"])
+        assert not second.acquire_lease("refresh:plot", "worker-2", 60)
+        await scheduler.stop()
+        assert second.acquire_lease("refresh:plot", "worker-2", 60)
+    asyncio.run(run())
+
+def test_scheduler_releases_the_refresh_lease_on_pause(tmp_path):
+    first, second = sqlite_backends(tmp_path)
+    async def run():
+        scheduler = PlotScheduler(
+            shared_cache.SharedResultCache(first, owner="worker-1"), lambda key, plot_info: {"x": [1], "y": [1]},
+            idle_timeout=0.1, tick=0.05, leases=first, owner="worker-1"
+        )
+        scheduler.add("plot", PLOT_INFO)
+        await scheduler.refresh("plot", scheduler.jobs["plot"])
+        assert not second.acquire_lease("refresh:plot", "worker-2", 60)
+        scheduler.start()
+        await asyncio.sleep(0.3)
+        assert second.acquire_lease("refresh:plot", "worker-2", 60)
+        await scheduler.stop()
+    asyncio.run(run())
+
+def test_scheduler_follower_ignores_stale_data(tmp_path):
+    first, second = sqlite_backends(tmp_path)
+    assert first.acquire_lease("refresh:plot", "worker-1", 60)
+    first.set("plot", {"x": [1], "y": [1]}, 0)
+    async def run():
+        scheduler = PlotScheduler(
+            shared_cache.SharedResultCache(second, owner="worker-2"), lambda key, plot_info: {"x": [2], "y": [2]},
+            leases=second, owner="worker-2"
+        )
+        scheduler.add("plot", PLOT_INFO)
+        await scheduler.refresh("plot", scheduler.jobs["plot"])
+        assert scheduler.jobs["plot"]["last_refresh"] is None
+        first.set("plot", {"x": [1], "y": [1]}, 60)
+        await scheduler.refresh("plot", scheduler.jobs["plot"])
+        assert scheduler.jobs["plot"]["last_refresh"] is not None
+        assert not scheduler.jobs["plot"]["leased"]
+    asyncio.run(run())
@@ -1,13 +1,23 @@
+import asyncio
+import functools
 import json
+import os
+import re
 import subprocess
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import plot_registry
+import metrics
+
+workspace_path = os.path.dirname(os.path.abspath(__file__))
+databases_config_path = os.path.join(workspace_path, "databases.json")
 
 def get_plot_info(plot_id:str):
-    with open("plot_info.json", "r") as f:
-        plots = json.load(f)
-        if plot_id in plots:
-            return plots[plot_id]
-    raise ValueError(f"Plot with id {plot_id} not found.")
+    plot_info = plot_registry.get_registry().get(plot_id)
+    if plot_info is None:
+        raise ValueError(f"Plot with id {plot_id} not found.")
+    return plot_info
 
 def remove_key_from_dicts(dict_list, key_to_remove):
     return [{k: v for k, v in d.items() if k != key_to_remove} for d in dict_list]
@@ -17,8 +27,12 @@ def export_config(config:dict,path):
         json.dump(config, f, indent=4)
 
 def save_databases_info(databases: list, databases_config_path:str):
-    with open(databases_config_path, 'w') as f:
+    """Save the databases configuration. The file is replaced atomically, so other processes never read a partial file.
+    """
+    tmp_path = f"{databases_config_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
         json.dump({"databases": databases}, f, indent=4)
+    os.replace(tmp_path, databases_config_path)
 
 def get_database_info(database_name:str,databases_config_path):
     """Get the information of the database. This will return a dictionary with the name and description of the database.
@@ -51,14 +65,68 @@ def run_command(cmd):
         print("Error:", stderr)
 
 def generate_plot_id(plot_data: dict) -> str:
+    """Generate the id of a plot. When the plot has a fingerprint, its query text is left out,
+    so that a plot created again with an equivalent query gets the same id.
+    """
     import hashlib
+    if plot_data.get("fingerprint"):
+        plot_data = {key: value for key, value in plot_data.items() if key != "query"}
     serialized = json.dumps(plot_data, sort_keys=True)
     return hashlib.sha256(serialized.encode()).hexdigest()
 
+def normalize_query(query:str):
+    """Normalize a query for use as a cache key. This collapses whitespace outside of quoted strings and removes the trailing semicolon.
+    """
+    query = re.sub(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""", lambda m: m.group(1) or " ", query)
+    return query.strip().rstrip(";").strip()
+
 def clean_query(query:str):
-    """Clean the query. This will remove the limit and order by clauses from the query.
+    """Clean the query before storing it. This collapses whitespace and removes the trailing semicolon, keeping quoted strings and identifiers intact.
+    """
+    return normalize_query(query)
+
+def canonicalize_query(query:str, dialect:str=None):
+    """Get the canonical form of a query, used to detect equivalent queries.
+    The query is parsed and regenerated with normalized whitespace, keyword and unquoted identifier case and literal quoting,
+    and the ORDER BY items of the outer query that refer to a column alias are replaced by the aliased expression.
+    Queries that cannot be parsed are only whitespace-normalized.
     """
-    return query.replace('"', '\\"').replace('\n', ' ').replace("'","")
+    import sqlglot
+    from sqlglot import exp
+    read = {"postgresql": "postgres"}.get(dialect, dialect)
+    try:
+        statement = sqlglot.parse_one(query, read=read)
+    except sqlglot.errors.ParseError:
+        return normalize_query(query)
+    if isinstance(statement, exp.Select) and statement.args.get("order"):
+        aliases = {e.alias: e.this for e in statement.expressions if isinstance(e, exp.Alias)}
+        for ordered in statement.args["order"].expressions:
+            column = ordered.this
+            if isinstance(column, exp.Column) and not column.table and column.name in aliases:
+                column.replace(aliases[column.name].copy())
+    return statement.sql(dialect=read, normalize=True)
+
+@functools.lru_cache(maxsize=4096)
+def _get_fingerprint(query:str, database_configs:str, x:str, y:str, limit, plot_type:str, incremental:bool=True):
+    config = json.loads(database_configs)
+    canonical = canonicalize_query(query, config.get("dialect"))
+    parts = [canonical, get_connection_url(config), x, y, limit, plot_type]
+    if not incremental:
+        parts.append("full refresh")
+    import hashlib
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+def get_plot_fingerprint(plot_info:dict):
+    """Get the fingerprint of the data of a plot. Plots with equivalent queries on the same database and the same
+    x, y, limit, type and incremental setting share the fingerprint, and so share their cached data and refresh job.
+    Plots refreshed incrementally (the default) keep the fingerprint they had before the setting existed.
+    """
+    if plot_info.get("fingerprint"):
+        return plot_info["fingerprint"]
+    return _get_fingerprint(
+        plot_info["query"], json.dumps(plot_info["database_configs"], sort_keys=True),
+        plot_info["x"], plot_info["y"], plot_info.get("limit"), plot_info["type"], bool(plot_info.get("incremental", True))
+    )
 
 def get_database_prompt(db:dict):
     """Get the database prompt. This will return a string with the name and description of the database.
@@ -71,34 +139,170 @@ def get_database_prompt(db:dict):
         prompt+= f"""{list(table.keys())[0]}{list(table.values())[0]}\n\n"""
     return prompt
 
-from sqlalchemy import create_engine, text, MetaData
+from sqlalchemy import create_engine, event, text, MetaData
 from sqlalchemy.schema import CreateTable
 
+DATABASE_WORKERS = int(os.getenv("OPENQUERYBI_DATABASE_WORKERS", "16"))
+
+_database_executor = ThreadPoolExecutor(max_workers=DATABASE_WORKERS, thread_name_prefix="database")
+
+async def run_blocking(function, *args, **kwargs):
+    """Run a blocking database call on the database executor, without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_database_executor, functools.partial(function, *args, **kwargs))
+
+STATEMENT_TIMEOUT = float(os.getenv("OPENQUERYBI_STATEMENT_TIMEOUT", "30"))
+POOL_OPTIONS = ("pool_size", "max_overflow", "pool_pre_ping", "pool_recycle", "pool_timeout")
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_connection_url(database_info:dict):
+    """Build the SQLAlchemy connection URL for a database config.
+    """
+    if database_info['dialect'] == "sqlite":
+        return f"sqlite:///{database_info['database']}"
+
+    elif database_info['dialect'] == "postgresql":
+        return (
+        f"postgresql://{database_info['username']}:{database_info['password']}"
+        f"@{database_info['host']}/{database_info['database']}"
+        f"?sslmode={database_info.get('sslmode','require')}&channel_binding={database_info.get('channel_binding','require')}"
+    )
+
+    return (
+        f"{database_info['dialect']}://{database_info['username']}:{database_info['password']}"
+        f"@{database_info['host']}:{database_info['port']}/{database_info['database']}"
+    )
+
+def get_pool_options(database_info:dict):
+    """Get the connection pool settings of a database config.
+    Remote databases ping connections before use and recycle them every 30 minutes unless configured otherwise.
+    """
+    options = {} if database_info['dialect'] == "sqlite" else {"pool_pre_ping": True, "pool_recycle": 1800}
+    options.update({k: database_info[k] for k in POOL_OPTIONS if database_info.get(k) not in (None, "")})
+    return options
+
+def get_statement_timeout(database_info:dict):
+    """Get the maximum duration of a statement in seconds, from the database config or OPENQUERYBI_STATEMENT_TIMEOUT.
+    """
+    return float(database_info.get("statement_timeout") or STATEMENT_TIMEOUT)
+
+def set_sqlite_timeout(engine, timeout:float):
+    """Interrupt SQLite statements that run for more than timeout seconds, including the time spent fetching their rows.
+    Connections are also made read-only with PRAGMA query_only.
+    """
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only=ON")
+        info = connection_record.info
+        dbapi_connection.set_progress_handler(lambda: int(time.monotonic() > info.get("deadline", float("inf"))), 10000)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["deadline"] = time.monotonic() + timeout
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info.pop("deadline", None)
+
+def get_engine_key(database_info:dict):
+    return json.dumps([get_connection_url(database_info), get_pool_options(database_info), get_statement_timeout(database_info)], sort_keys=True)
+
+def get_engine(database_info:dict):
+    """Get the pooled engine of a database config. Engines are created once per process and reused by every query.
+    """
+    key = get_engine_key(database_info)
+    engine = _engines.get(key)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(key)
+            if engine is None:
+                timeout = get_statement_timeout(database_info)
+                options = get_pool_options(database_info)
+                if database_info['dialect'] == "postgresql":
+                    options["connect_args"] = {"options": f"-c statement_timeout={int(timeout * 1000)} -c default_transaction_read_only=on"}
+                engine = create_engine(get_connection_url(database_info), **options)
+                if database_info['dialect'] == "sqlite":
+                    set_sqlite_timeout(engine, timeout)
+                _engines[key] = engine
+                metrics.increment("openquerybi_engines_created_total", database=metrics.get_database_label(database_info))
+    return engine
+
+def dispose_engine(database_info:dict):
+    """Close the pooled connections of a database config, if it has an engine.
+    """
+    with _engines_lock:
+        engine = _engines.pop(get_engine_key(database_info), None)
+    if engine is not None:
+        engine.dispose()
+
+def dispose_engines():
+    """Close every pooled engine of the process.
+    """
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+
 class Database():
     def __init__(self, config:dict):
+        self.config = config
         self.dialect = config.get('dialect')
         self.connection_url = ""
 
     def get_connection_url(self):
         raise NotImplementedError("This method should be implemented by subclasses.")
 
+    def get_schema_fingerprint(self):
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
     def query(self, query:str):
         """Run a query on the database. This will return the result of the query.
         """
-        engine = create_engine(self.connection_url)
-        with engine.connect() as conn:
+        engine = get_engine(self.config)
+        with metrics.query_span(self.config, "query", query) as span, engine.connect() as conn:
             result = conn.execute(text(query))
-            return result.fetchall(),list(result.keys())
+            rows = result.fetchall()
+            span["rows"] = len(rows)
+            return rows,list(result.keys())
+
+    def query_columns(self, query:str, columns:list, limit:int=None, batch_size:int=10000, params:dict=None):
+        """Run a query on the database and return the values of the given columns as one list per column.
+        Rows are streamed in batches and transposed batch by batch, without keeping the full result as rows.
+        """
+        engine = get_engine(self.config)
+        with metrics.query_span(self.config, "query_columns", query) as span, engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(text(query), params or {})
+            keys = list(result.keys())
+            indexes = [keys.index(column) for column in columns]
+            values = [[] for _ in columns]
+            remaining = limit
+            for batch in result.partitions(batch_size if limit is None else min(batch_size, limit)):
+                if remaining is not None:
+                    batch = batch[:remaining]
+                    remaining -= len(batch)
+                transposed = list(zip(*batch))
+                for value, index in zip(values, indexes):
+                    value.extend(transposed[index])
+                if remaining == 0:
+                    break
+            result.close()
+            span["rows"] = len(values[0]) if values else 0
+            return values
             
     def export_schema_as_sql(self):
         """Export the schema of the database as a SQL script. This will return the SQL script of each table as a list of dicts.
         """
-        engine = create_engine(self.connection_url)
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-        table_schemas = []
-        for table in metadata.sorted_tables:
-            table_schemas.append({table.name:str(CreateTable(table).compile(engine))})
+        engine = get_engine(self.config)
+        with metrics.span("openquerybi_reflection_duration_seconds", database=metrics.get_database_label(self.config), operation="export_schema"):
+            metadata = MetaData()
+            metadata.reflect(bind=engine)
+            table_schemas = []
+            for table in metadata.sorted_tables:
+                table_schemas.append({table.name:str(CreateTable(table).compile(engine))})
         return table_schemas
     
     def format_data_as_table(self, rows, columns):
@@ -113,7 +317,8 @@ class Database():
         """Get sample rows from a table in the database. This will return the result of the query.
         """
         query = f"SELECT * FROM {table} LIMIT {limit};"
-        rows, columns = self.query(query)
+        with metrics.span("openquerybi_reflection_duration_seconds", database=metrics.get_database_label(self.config), operation="sample_rows"):
+            rows, columns = self.query(query)
         if format:
             return self.format_data_as_table(rows, columns)
         return rows,columns
@@ -127,6 +332,12 @@ class SQLiteDatabase(Database):
     def get_connection_url(self):
         return f"sqlite:///{self.path}"
 
+    def get_schema_fingerprint(self):
+        """Get a value that changes whenever the schema of the SQLite database changes.
+        """
+        data, _ = self.query("PRAGMA schema_version;")
+        return str(data[0][0])
+
     def get_table_columns(self, table:str):
         """Get the columns of a table in the SQLite database. This will return the name of each column.
         """
@@ -155,6 +366,17 @@ class PostgresDatabase(Database):
         f"?sslmode={self.sslmode}&channel_binding={self.channel_binding}"
     )
         
+    def get_schema_fingerprint(self):
+        """Get a value that changes whenever the tables or columns of the Postgres database change.
+        """
+        query = (
+            "SELECT md5(coalesce(string_agg(table_schema || '.' || table_name || '.' || column_name || ':' || data_type, ',' "
+            "ORDER BY table_schema, table_name, ordinal_position), '')) FROM information_schema.columns "
+            "WHERE table_schema NOT IN ('pg_catalog', 'information_schema');"
+        )
+        data, _ = self.query(query)
+        return str(data[0][0])
+
     def get_table_columns(self, table:str):
         """Get the columns of a table in the SQLite database. This will return the name of each column.
         """